@@ -1,5 +1,10 @@
 from loguru import logger
 from neo4j import GraphDatabase
+from collections import Counter, OrderedDict
+from csvexport import CSVExport, stableUUID
+from instrument import Instrumentation, InstrumentedDriver
+from unitofwork import UnitOfWork, runStatements
+from spatial import PointGrid
 import os
 import csv
 
@@ -7,31 +12,240 @@ DB_URI = os.environ.get( "DB_URI", "bolt://localhost:7687" )
 DB_USER = os.environ.get( "DB_USER", "neo4j" )
 DB_PASS = os.environ.get( "DB_PASS", "demoServer" )
 
+# Per-statement timing: NEOBRIDGE_STATS=1 to log a summary on close (and every _INTERVAL seconds, if set),
+# NEOBRIDGE_STATS_FILE to also write it out as .json or Prometheus text
+STATS = os.environ.get( "NEOBRIDGE_STATS", "" ) not in [ "", "0" ]
+STATS_FILE = os.environ.get( "NEOBRIDGE_STATS_FILE", None )
+STATS_INTERVAL = float( os.environ.get( "NEOBRIDGE_STATS_INTERVAL", "0" ) )
+
+# Queued writes are committed every COMMIT_OPS statements or COMMIT_MS milliseconds
+COMMIT_OPS = int( os.environ.get( "NEOBRIDGE_COMMIT_OPS", "1000" ) )
+COMMIT_MS = int( os.environ.get( "NEOBRIDGE_COMMIT_MS", "1000" ) )
+
+# Default for the tools' --concurrency option (0 = write synchronously)
+CONCURRENCY = int( os.environ.get( "NEOBRIDGE_CONCURRENCY", "0" ) )
+
 class NeoBridge:
-    def __init__(self, name = "unknown", version = "0.0.1", uri = DB_URI, user = DB_USER, password = DB_PASS):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    def __init__(self, name = "unknown", version = "0.0.1", uri = DB_URI, user = DB_USER, password = DB_PASS, export = None, concurrency = 0):
         self.name = name
         self.version = version
 
+        # Dimension caches: label -> (key properties, {key values: uuid}, max entries or None)
+        self.dimensions = {}
+        self.cacheHits = Counter()
+        self.cacheMisses = Counter()
+
+        # Offline mode: write neo4j-admin import CSVs instead of talking to a database
+        self.export = None
+        self.instrumentation = None
+        self.asyncWriter = None
+        self.points = None
+        if export is not None:
+            self.driver = None
+            self.uow = None
+            self.export = CSVExport( export )
+
+            # With no database to ask, spatial queries are answered from the places exported this run
+            self.points = PointGrid()
+            self.addIndexedUUID( "Toolchain" )
+            self.schema( "CREATE INDEX toolName IF NOT EXISTS FOR (t:Toolchain) ON (t.name)" )
+
+            self.uuid = stableUUID( "Toolchain", self.name, self.version )
+            self.export.node( "Toolchain", self.uuid, { "name": self.name, "version": self.version } )
+            logger.info( f"Exporting to {export}, Toolchain UUID = {self.uuid}" )
+            return
+
+        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+
+        # Only wrap the driver when asked, so there's no cost at all otherwise
+        self.instrumentation = None
+        if STATS or STATS_FILE is not None:
+            self.instrumentation = Instrumentation( self.name, STATS_FILE, STATS_INTERVAL )
+            self.driver = InstrumentedDriver( self.driver, self.instrumentation )
+
+        # Everything goes through one long-lived session and explicit, batched transactions
+        self.uow = UnitOfWork( self.driver, COMMIT_OPS, COMMIT_MS )
+
+        # Bulk writes (see write()) can instead go through an AsyncDriver, several transactions at a time
+        if concurrency > 0:
+            from asyncwriter import AsyncWriter
+            self.asyncWriter = AsyncWriter( uri, (user, password), concurrency, self.instrumentation )
+
         self.addIndexedUUID( "Toolchain" )
+        self.schema( "CREATE INDEX toolName IF NOT EXISTS FOR (t:Toolchain) ON (t.name)" )
 
-        with self.driver.session() as session:
-            session.run( "CREATE INDEX toolName IF NOT EXISTS FOR (t:Toolchain) ON (t.name)" );
-            session.run( "MERGE (n:Toolchain {name: $name, version: $version}) return n.uuid", name=self.name, version=self.version )
-            res = session.run( "MATCH (n:Toolchain {name: $name, version: $version}) RETURN n.uuid", name=self.name, version=self.version )
-            self.uuid = res.single()[0];
-            logger.info( f"Toolchain UUID = {self.uuid}" )
-            session.close();
+        res = self.uow.query(
+            "MERGE (n:Toolchain {name: $name, version: $version}) SET n.uuid = coalesce(n.uuid, randomUUID()) RETURN n.uuid",
+            name=self.name,
+            version=self.version
+        )
+        self.uuid = res[0][0]
+        logger.info( f"Toolchain UUID = {self.uuid}" )
 
     def addIndexedUUID( self, label ):
         cName = f"{label.lower()}UUID"
 
         logger.debug( f"Creating index, constraint and automatic UUID for {label} (cName = {cName})" )
 
-        with self.driver.session() as session:
-            session.run( f"CREATE CONSTRAINT {cName} IF NOT EXISTS FOR (n:{label}) REQUIRE n.uuid IS UNIQUE" )
-            session.run( f"CALL apoc.uuid.install('{label}', {{addToExistingNodes: true, uuidProperty: 'uuid'}})" )
-            session.close()
+        self.schema( f"CREATE CONSTRAINT {cName} IF NOT EXISTS FOR (n:{label}) REQUIRE n.uuid IS UNIQUE" )
+        self.schema( f"CALL apoc.uuid.install('{label}', {{addToExistingNodes: true, uuidProperty: 'uuid'}})" )
+
+    def schema( self, statement ):
+        # Indexes, constraints and triggers; saved for after the import when exporting
+        if self.export is not None:
+            self.export.addSchema( statement )
+            return
+
+        self.uow.autocommit( statement )
+
+    def addDimension( self, label, keys, maxSize = None ):
+        # Small, repetitive node sets (lemmas, tags, counties...) that we resolve to a UUID once per run.
+        # Open-ended ones (entities) pass maxSize: nothing is preloaded, and the cache only keeps the
+        # maxSize most recently used keys, merging anything else as it comes up
+        self.addIndexedUUID( label )
+
+        if maxSize is not None:
+            self.dimensions[label] = (keys, OrderedDict(), maxSize)
+            return
+
+        cache = {}
+        if self.export is not None:
+            self.dimensions[label] = (keys, cache, None)
+            return
+
+        res = self.uow.fetch( f"MATCH (n:{label}) WHERE n.uuid IS NOT NULL RETURN [k IN $keys | n[k]], n.uuid", keys=keys )
+        for record in res:
+            cache[tuple(record[0])] = record[1]
+
+        logger.debug( f"Pre-warmed {len(cache)} {label} nodes" )
+        self.dimensions[label] = (keys, cache, None)
+
+    def resolveDimensions( self, label, rows ):
+        (keys, cache, maxSize) = self.dimensions[label]
+
+        missing = {}
+        for row in rows:
+            key = tuple( row[k] for k in keys )
+            if key in cache:
+                self.cacheHits[label] += 1
+                if maxSize is not None:
+                    cache.move_to_end( key )
+            elif key not in missing:
+                self.cacheMisses[label] += 1
+                missing[key] = { k: row[k] for k in keys }
+
+        if self.export is not None:
+            for (key, props) in missing.items():
+                cache[key] = stableUUID( label, *key )
+                self.export.node( label, cache[key], props )
+
+        # Anything we haven't seen yet is merged (and committed) before any caller can link to it
+        elif len(missing) > 0:
+            res = self.uow.query(
+                f"UNWIND $rows AS row MERGE (n:{label} {{" + ", ".join( f"{k}: row.{k}" for k in keys ) + "}) "
+                "SET n.uuid = coalesce(n.uuid, randomUUID()) "
+                "RETURN [k IN $keys | row[k]], n.uuid",
+                rows=list(missing.values()),
+                keys=keys
+            )
+            for record in res:
+                cache[tuple(record[0])] = record[1]
+
+        uuids = [ cache[tuple( row[k] for k in keys )] for row in rows ]
+        if maxSize is not None:
+            while len(cache) > maxSize:
+                cache.popitem( last=False )
+        return uuids
+
+    def dimension( self, label, **props ):
+        return self.resolveDimensions( label, [props] )[0]
+
+    def logCacheStats( self ):
+        for label in self.dimensions:
+            hits = self.cacheHits[label]
+            misses = self.cacheMisses[label]
+            total = hits + misses
+            logger.info( f"{label} cache: {hits} hits, {misses} misses ({100.0 * hits / total if total else 0:.1f}% hit rate)" )
+
+    def write( self, statements, *args ):
+        # Bulk writes: `statements` is a generator function yielding (query, params) pairs (see
+        # unitofwork.runStatements). Dimensions are resolved synchronously, in this one lane, before
+        # we get here, so these only link to existing nodes and are safe to run side by side. Returns
+        # the generator's result, or a Future for it when writing asynchronously.
+        if self.asyncWriter is not None:
+            return self.asyncWriter.submit( statements, *args )
+
+        return self.uow.write( runStatements, statements, args )
+
+    def afterWrites( self, fn, *args ):
+        # Run fn once everything passed to write() so far has committed (straight away when synchronous)
+        if self.asyncWriter is not None:
+            return self.asyncWriter.after( fn, *args )
+
+        fn( *args )
+
+    # Spatial queries over Place locations (see ipn2neo4j), as (uuid, name, lat, lon, metres) rows
+    def placesWithin( self, lat, lon, metres ):
+        if self.points is not None:
+            return self.points.within( lat, lon, metres )
+
+        res = self.uow.fetch(
+            "WITH point({latitude: $lat, longitude: $lon}) AS centre "
+            "MATCH (p:Place) WHERE point.distance(p.location, centre) <= $metres "
+            "RETURN p.uuid, p.name, p.location.latitude, p.location.longitude, point.distance(p.location, centre) AS metres "
+            "ORDER BY metres",
+            lat=lat, lon=lon, metres=metres
+        )
+        return [ tuple(record) for record in res ]
+
+    def nearestPlaces( self, lat, lon, k = 10, maxMetres = 200000 ):
+        if self.points is not None:
+            return self.points.nearest( lat, lon, k )
+
+        # The point index answers distance ranges, not k-nearest, so widen the range until it holds k places
+        metres = 1000
+        while True:
+            rows = self.placesWithin( lat, lon, metres )
+            if len(rows) >= k or metres >= maxMetres:
+                return rows[:k]
+            metres = min( maxMetres, metres * 4 )
+
+    def placesInBox( self, south, west, north, east ):
+        if self.points is not None:
+            return self.points.inBox( south, west, north, east )
+
+        res = self.uow.fetch(
+            "MATCH (p:Place) WHERE point.withinBBox(p.location, point({latitude: $south, longitude: $west}), point({latitude: $north, longitude: $east})) "
+            "RETURN p.uuid, p.name, p.location.latitude, p.location.longitude, null",
+            south=south, west=west, north=north, east=east
+        )
+        return [ tuple(record) for record in res ]
+
+    # Small bits of per-toolchain state (high-water marks, checkpoints), kept on our Toolchain node
+    def getState( self, key, default = None ):
+        if self.export is not None:
+            return default
+
+        res = self.uow.fetch( "MATCH (n:Toolchain {uuid: $uuid}) RETURN n[$key]", uuid=self.uuid, key=key )
+        value = res[0][0]
+        return default if value is None else value
+
+    def setState( self, key, value ):
+        if self.export is not None:
+            return
+
+        # Queued behind (so committed with or after) everything written before it
+        self.uow.run( "MATCH (n:Toolchain {uuid: $uuid}) SET n += $state", uuid=self.uuid, state={key: value} )
 
     def close(self):
+        self.logCacheStats()
+        if self.export is not None:
+            self.export.close()
+            return
+
+        if self.asyncWriter is not None:
+            self.asyncWriter.close()
+        self.uow.close()
+        if self.instrumentation is not None:
+            self.instrumentation.dump()
         self.driver.close()
\ No newline at end of file
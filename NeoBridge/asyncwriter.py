@@ -0,0 +1,116 @@
+from loguru import logger
+from neo4j import AsyncGraphDatabase
+from collections import deque
+from instrument import templateName
+import threading
+import asyncio
+import time
+
+
+async def runStatementsAsync( tx, statements, args, instrumentation = None ):
+    # The async twin of unitofwork.runStatements, timing each statement when instrumented
+    gen = statements( *args )
+    try:
+        (query, params) = next( gen )
+        while True:
+            start = time.perf_counter()
+            result = await tx.run( query, params )
+            records = [ record async for record in result ]
+            if instrumentation is not None:
+                summary = await result.consume()
+                instrumentation.record( templateName( query ), time.perf_counter() - start, summary )
+            (query, params) = gen.send( records )
+    except StopIteration as stop:
+        return stop.value
+
+
+class AsyncWriter:
+    # Runs write transactions on an AsyncDriver, in an event loop on its own thread, with at most
+    # `concurrency` in flight. Callers stay synchronous: submit() hands back a Future, and after()
+    # queues a callback to run (on the caller's thread, from poll/drain) once everything submitted
+    # before it has committed, so checkpoints never get ahead of the data.
+
+    def __init__( self, uri, auth, concurrency, instrumentation = None ):
+        self.concurrency = concurrency
+        self.instrumentation = instrumentation
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread( target=self.loop.run_forever, name="AsyncWriter", daemon=True )
+        self.thread.start()
+
+        self.driver = asyncio.run_coroutine_threadsafe( self._open( uri, auth ), self.loop ).result()
+        self.slots = threading.BoundedSemaphore( concurrency )
+
+        self.lock = threading.Condition()
+        self.submitted = 0
+        self.finished = set()
+        self.watermark = 0
+        self.callbacks = deque()
+        self.error = None
+
+        logger.info( f"Writing asynchronously with {concurrency} transactions in flight" )
+
+    async def _open( self, uri, auth ):
+        return AsyncGraphDatabase.driver( uri, auth=auth, max_connection_pool_size=self.concurrency )
+
+    async def _write( self, statements, args ):
+        start = time.perf_counter()
+        async with self.driver.session() as session:
+            result = await session.execute_write( runStatementsAsync, statements, args, self.instrumentation )
+
+        # As InstrumentedSession does: the whole transaction, retries and commit included, under the work's name
+        if self.instrumentation is not None:
+            self.instrumentation.record( f"transaction: {getattr( statements, '__name__', 'work' )}", time.perf_counter() - start )
+        return result
+
+    def submit( self, statements, *args ):
+        self.poll()
+        self.slots.acquire()
+
+        with self.lock:
+            self.submitted = self.submitted + 1
+            seq = self.submitted
+
+        future = asyncio.run_coroutine_threadsafe( self._write( statements, args ), self.loop )
+        future.add_done_callback( lambda f: self._done( seq, f ) )
+        return future
+
+    def _done( self, seq, future ):
+        with self.lock:
+            if future.exception() is not None and self.error is None:
+                self.error = future.exception()
+
+            self.finished.add( seq )
+            while self.watermark + 1 in self.finished:
+                self.watermark = self.watermark + 1
+                self.finished.discard( self.watermark )
+            self.lock.notify_all()
+        self.slots.release()
+
+    def after( self, fn, *args ):
+        with self.lock:
+            self.callbacks.append( (self.submitted, fn, args) )
+        self.poll()
+
+    def poll( self ):
+        while True:
+            with self.lock:
+                if self.error is not None:
+                    raise self.error
+                if len(self.callbacks) == 0 or self.callbacks[0][0] > self.watermark:
+                    return
+                (seq, fn, args) = self.callbacks.popleft()
+            fn( *args )
+
+    def drain( self ):
+        with self.lock:
+            while self.watermark < self.submitted and self.error is None:
+                self.lock.wait()
+        self.poll()
+
+    def close( self ):
+        try:
+            self.drain()
+        finally:
+            asyncio.run_coroutine_threadsafe( self.driver.close(), self.loop ).result()
+            self.loop.call_soon_threadsafe( self.loop.stop )
+            self.thread.join()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+from loguru import logger
+from optparse import OptionParser
+import NeoBridge as bridge
+import multiprocessing
+import resource
+import random
+import uuid
+import json
+import time
+import csv
+import os
+import sys
+
+parser = OptionParser()
+parser.add_option( "--sizes", dest="sizes", help="Comma separated IPN row counts to run (the corpus gets one paragraph per 10 rows)", default="100,1000,10000" )
+parser.add_option( "--backend", dest="backend", help="Run against 'offline' (in-memory stand-in), 'live' (DB_URI) or 'both'", default="offline" )
+parser.add_option( "--stages", dest="stages", help="Comma separated stages to run, from ipn,spacy,link", default="ipn,spacy,link" )
+parser.add_option( "--model", dest="spacy_data", help="Set the spacy training data to use ('blank' for a tokenizer only pipeline)", default="en_core_web_lg" )
+parser.add_option( "--batch-size", dest="batchSize", help="IPN rows per batch (0 = one row at a time)", type="int", default=500 )
+parser.add_option( "--workdir", dest="workdir", help="Where to write the synthetic inputs", metavar="DIR", default="./bench-data" )
+parser.add_option( "-o", "--output", dest="output", help="Append JSON results to FILE (default: stdout)", metavar="FILE", default=None )
+parser.add_option( "--seed", dest="seed", help="Random seed for the synthetic data", type="int", default=1 )
+
+RealGraphDatabase = bridge.GraphDatabase
+
+IPN_COLUMNS = [ "placeid", "place22cd", "place22nm", "descnm", "lat", "long", "ctry22nm", "ctyhistnm", "cty61nm", "cty91nm", "ctyltnm", "lad61nm", "lad91nm" ]
+SYLLABLES = [ "ash", "bury", "ford", "ton", "ley", "wick", "ham", "chester", "by", "thorpe", "new", "kings", "mar", "den", "wood", "bridge" ]
+WORDS = [ "the", "old", "road", "to", "was", "a", "market", "town", "near", "river", "and", "church", "of", "in", "mill", "we", "walked", "north" ]
+
+
+### Synthetic inputs ###
+
+def placeName( rng ):
+    return "".join( rng.choice( SYLLABLES ) for i in range( rng.randint( 2, 3 ) ) ).capitalize()
+
+def writeIPN( path, rows, rng ):
+    names = []
+    with open( path, "w", newline="", encoding="latin-1" ) as sourceCSV:
+        writer = csv.writer( sourceCSV )
+        writer.writerow( IPN_COLUMNS )
+        for i in range( rows ):
+            name = placeName( rng )
+            names.append( name )
+            county = placeName( rng ) + "shire"
+            writer.writerow( [
+                f"IPN{i:07d}", f"IPN22{i:07d}", name, rng.choice( ["LOC", "PAR", "BUA", "PARK"] ),
+                f"{rng.uniform( 50.0, 58.5 ):.5f}", f"{rng.uniform( -5.5, 1.7 ):.5f}", rng.choice( ["England", "Scotland", "Wales"] ),
+                county, county, rng.choice( [county, ""] ), county, placeName( rng ), rng.choice( [placeName( rng ), ""] )
+            ] )
+    return names
+
+def writeCorpus( path, paragraphs, names, rng ):
+    with open( path, "w" ) as sourceXML:
+        sourceXML.write( "<corpus>\n" )
+        for i in range( paragraphs ):
+            if i % 20 == 0:
+                if i > 0:
+                    sourceXML.write( "</source>\n" )
+                sourceXML.write( f"<source><title>Synthetic {i // 20}</title><url>https://example.org/{i // 20}</url>\n" )
+            words = [ rng.choice( WORDS ) for w in range( 60 ) ]
+            for w in range( 0, 60, 15 ):
+                words[w] = rng.choice( names )
+            sourceXML.write( f"<para>{' '.join( words ).capitalize()}.</para>\n" )
+        sourceXML.write( "</source>\n</corpus>\n" )
+
+
+### Driver stand-ins ###
+
+class CountingDriver:
+    # Wraps a (real or fake) driver, counting every statement sent through it
+
+    def __init__( self, driver ):
+        self.driver = driver
+        self.statements = 0
+
+    def session( self, **kwargs ):
+        return CountingSession( self, self.driver.session( **kwargs ) )
+
+    def close( self ):
+        self.driver.close()
+
+
+class CountingSession:
+
+    def __init__( self, counter, session ):
+        self.counter = counter
+        self.session = session
+
+    def run( self, query, parameters = None, **kwargs ):
+        self.counter.statements = self.counter.statements + 1
+        return self.session.run( query, parameters, **kwargs )
+
+    def execute_write( self, work, *args, **kwargs ):
+        return self.session.execute_write( lambda tx: work( CountingSession( self.counter, tx ), *args, **kwargs ) )
+
+    def execute_read( self, work, *args, **kwargs ):
+        return self.session.execute_read( lambda tx: work( CountingSession( self.counter, tx ), *args, **kwargs ) )
+
+    def close( self ):
+        self.session.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.session.close()
+
+
+class FakeResult(list):
+
+    def single( self ):
+        return self[0] if len(self) > 0 else None
+
+    def consume( self ):
+        return None
+
+
+class FakeSession:
+    # Accepts any statement and makes up results shaped like the ones our tools read back
+
+    def __init__( self, state ):
+        self.state = state
+
+    def run( self, query, parameters = None, **kwargs ):
+        params = dict( parameters or {}, **kwargs )
+        if "RETURN" not in query:
+            if "SET n +=" in query:
+                self.state.update( params["state"] )
+            return FakeResult()
+
+        if "[k IN $keys | row[k]]" in query:
+            return FakeResult( [ [row[k] for k in params["keys"]], str(uuid.uuid4()) ] for row in params["rows"] )
+        if "RETURN i, t.uuid" in query:
+            return FakeResult( [i, str(uuid.uuid4())] for i in range( len(params["text"]) ) )
+        if "RETURN timestamp()" in query:
+            return FakeResult( [ [int( time.time() * 1000 )] ] )
+        if "n[$key]" in query:
+            return FakeResult( [ [self.state.get( params["key"] )] ] )
+        if "IS NOT NULL RETURN" in query:
+            return FakeResult()
+        return FakeResult( [ [str(uuid.uuid4())] ] )
+
+    def execute_write( self, work, *args, **kwargs ):
+        return work( self, *args, **kwargs )
+
+    def execute_read( self, work, *args, **kwargs ):
+        return work( self, *args, **kwargs )
+
+    def close( self ):
+        pass
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        pass
+
+
+class FakeDriver:
+
+    def __init__( self ):
+        self.state = {}
+
+    def session( self, **kwargs ):
+        return FakeSession( self.state )
+
+    def close( self ):
+        pass
+
+
+class FakeGraphDatabase:
+
+    @staticmethod
+    def driver( uri, auth = None, **kwargs ):
+        return FakeDriver()
+
+
+### Stages ###
+
+def peakRSS():
+    # ru_maxrss is in KB on Linux (bytes on macOS). It only ever goes up, so each stage runs in a
+    # fresh process of its own (see runStage) and this is that stage's peak
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+def measure( db, stage, work ):
+    counter = CountingDriver( db.driver )
+    db.uow.setDriver( counter )
+
+    start = time.perf_counter()
+    items = work()
+    db.uow.commit()
+    wall = time.perf_counter() - start
+
+    db.uow.setDriver( db.driver )
+    return {
+        "stage": stage,
+        "wall": wall,
+        "items": items,
+        "itemsPerSecond": items / wall if wall > 0 else None,
+        "statements": counter.statements,
+        "peakRSS": peakRSS()
+    }
+
+def benchIPN( path, batchSize ):
+    from ipn2neo4j import IPN2Neo4j
+
+    db = IPN2Neo4j()
+
+    def work():
+        rows = 0
+        with open( path, newline='', encoding='latin-1' ) as sourceCSV:
+            ipnReader = csv.reader( sourceCSV )
+            header = next( ipnReader )
+
+            batch = []
+            for row in ipnReader:
+                rows = rows + 1
+                if batchSize <= 0:
+                    db.updateRow( header, row )
+                    continue
+
+                batch.append( row )
+                if len(batch) >= batchSize:
+                    db.updateRows( header, batch )
+                    batch = []
+            if len(batch) > 0:
+                db.updateRows( header, batch )
+        return rows
+
+    result = measure( db, "ipn", work )
+    db.close()
+    return result
+
+def benchSpacy( path, model ):
+    import spacy2neo4j
+    import spacy
+
+    nlp = spacy.blank( "en" ) if model == "blank" else spacy.load( model )
+    (options, args) = spacy2neo4j.parser.parse_args( ["--tokens", "--entities"] )
+    db = spacy2neo4j.Spacy2Neo4j()
+
+    # Count tokens as they go past on their way to the writer
+    counted = { "tokens": 0 }
+    update_tokens = db.update_tokens
+    def countingUpdate( srcUUID, paraIndex, doc ):
+        counted["tokens"] = counted["tokens"] + len(doc)
+        return update_tokens( srcUUID, paraIndex, doc )
+    db.update_tokens = countingUpdate
+
+    def work():
+        spacy2neo4j.runPipeline( db, nlp, spacy2neo4j.readXML( path ), options )
+        return counted["tokens"]
+
+    result = measure( db, "spacy", work )
+    db.close()
+    return result
+
+def benchLink():
+    from linker import CorpusLinker
+
+    db = CorpusLinker()
+
+    # One full linking pass, so itemsPerSecond is passes per second
+    result = measure( db, "link", lambda: db.tryLinking( full=True ) or 1 )
+    db.close()
+    return result
+
+
+def stageMain( stage, backend, ipnPath, corpusPath, batchSize, model ):
+    bridge.GraphDatabase = FakeGraphDatabase if backend == "offline" else RealGraphDatabase
+
+    if stage == "ipn":
+        return benchIPN( ipnPath, batchSize )
+    if stage == "spacy":
+        return benchSpacy( corpusPath, model )
+    if stage == "link":
+        return benchLink()
+    raise ValueError( f"Unknown stage '{stage}'" )
+
+def runStage( *args ):
+    # Spawned, not forked, so the child doesn't inherit our high-water mark along with our memory
+    with multiprocessing.get_context( "spawn" ).Pool( 1 ) as pool:
+        return pool.apply( stageMain, args )
+
+
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+
+    backends = [ "offline", "live" ] if options.backend == "both" else [ options.backend ]
+    stages = options.stages.split( "," )
+    os.makedirs( options.workdir, exist_ok=True )
+
+    results = []
+    for size in [ int(s) for s in options.sizes.split( "," ) ]:
+        rng = random.Random( options.seed )
+        ipnPath = os.path.join( options.workdir, f"ipn-{size}.csv" )
+        corpusPath = os.path.join( options.workdir, f"corpus-{size}.xml" )
+        names = writeIPN( ipnPath, size, rng )
+        writeCorpus( corpusPath, max( 1, size // 10 ), names, rng )
+
+        for backend in backends:
+            for stage in stages:
+                logger.info( f"Running {stage} at size {size} ({backend})..." )
+                result = runStage( stage, backend, ipnPath, corpusPath, options.batchSize, options.spacy_data )
+
+                result.update( { "size": size, "backend": backend, "time": time.time() } )
+                logger.info( result )
+                results.append( result )
+
+    if options.output is None:
+        json.dump( results, sys.stdout, indent=2 )
+        sys.stdout.write( "\n" )
+    else:
+        with open( options.output, "a" ) as output:
+            for result in results:
+                output.write( json.dumps( result ) + "\n" )
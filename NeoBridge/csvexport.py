@@ -0,0 +1,138 @@
+from loguru import logger
+import uuid
+import csv
+import os
+
+# Namespace for the deterministic UUIDs we hand out in place of apoc.uuid
+UUID_NAMESPACE = uuid.UUID( "6f1c1f2e-2b0e-4f43-9a55-5b2d1c3e7a10" )
+
+# Joins array values; neo4j-admin's default (";") turns up in token text, so we use a control
+# character instead and tell the import about it
+ARRAY_DELIMITER = "\x1f"
+
+def stableUUID( label, *values ):
+    return str( uuid.uuid5( UUID_NAMESPACE, "|".join( [label] + [str(v) for v in values] ) ) )
+
+
+def headerType( value ):
+    if isinstance( value, bool ):
+        return ":boolean"
+    if isinstance( value, int ):
+        return ":long"
+    if isinstance( value, float ):
+        return ":double"
+    if isinstance( value, (list, tuple) ):
+        if len(value) > 0 and isinstance( value[0], int ) and not isinstance( value[0], bool ):
+            return ":long[]"
+        return ":string[]"
+    if isinstance( value, dict ):
+        return ":point{crs:WGS-84}"
+    return ""
+
+
+class CSVExport:
+    # Writes nodes and relationships as neo4j-admin import CSVs, one file (plus header file) per label/type
+
+    def __init__( self, directory ):
+        self.directory = directory
+        os.makedirs( directory, exist_ok=True )
+
+        self.files = {}
+        self.seen = {}
+        self.schema = []
+        self.counts = {}
+
+    def _open( self, name, kind, header ):
+        if name not in self.files:
+            with open( os.path.join( self.directory, f"{name}.header.csv" ), "w", newline="" ) as headerFile:
+                csv.writer( headerFile ).writerow( header )
+
+            handle = open( os.path.join( self.directory, f"{name}.csv" ), "w", newline="" )
+            self.files[name] = (kind, handle, csv.writer( handle ), header)
+            self.counts[name] = 0
+
+        self.counts[name] = self.counts[name] + 1
+        return self.files[name]
+
+    def node( self, label, nodeUUID, props, dedupe = True, types = None ):
+        # Returns False (and writes nothing) if we've already exported this node
+        if dedupe:
+            seen = self.seen.setdefault( label, set() )
+            key = uuid.UUID( nodeUUID ).bytes
+            if key in seen:
+                return False
+            seen.add( key )
+
+        # The first node of each label fixes the columns for its file (types overrides any we can't guess, like empty lists)
+        header = None
+        if label not in self.files:
+            types = types or {}
+            header = ["uuid:ID"] + [ f"{k}{types.get( k, headerType( props[k] ) )}" for k in sorted( props.keys() ) ] + [":LABEL"]
+        (kind, handle, writer, header) = self._open( label, "nodes", header )
+
+        columns = [ h.split( ":" )[0] for h in header[1:-1] ]
+        self._checkColumns( label, columns, props )
+        writer.writerow( [nodeUUID] + [ self._value( props.get( k ) ) for k in columns ] + [label] )
+        return True
+
+    def relationship( self, relType, startUUID, endUUID, props = None ):
+        # As with nodes, the first relationship of each type fixes its property columns
+        props = props or {}
+        header = None
+        if relType not in self.files:
+            header = [":START_ID", ":END_ID", ":TYPE"] + [ f"{k}{headerType( props[k] )}" for k in sorted( props.keys() ) ]
+        (kind, handle, writer, header) = self._open( relType, "relationships", header )
+
+        columns = [ h.split( ":" )[0] for h in header[3:] ]
+        self._checkColumns( relType, columns, props )
+        writer.writerow( [startUUID, endUUID, relType] + [ self._value( props.get( k ) ) for k in columns ] )
+
+    @staticmethod
+    def _checkColumns( name, columns, props ):
+        # A property the first row didn't have has no column to go in; fail rather than lose it
+        unknown = sorted( set( props.keys() ) - set( columns ) )
+        if len(unknown) > 0:
+            raise ValueError( f"{name} has no CSV column for {', '.join( unknown )}; give every row the same keys (types= can type empty ones)" )
+
+    @staticmethod
+    def _value( value ):
+        if value is None:
+            return ""
+        if isinstance( value, bool ):
+            return "true" if value else "false"
+        if isinstance( value, (list, tuple) ):
+            return ARRAY_DELIMITER.join( str(v).replace( ARRAY_DELIMITER, "" ) for v in value )
+        if isinstance( value, dict ):
+            return "{latitude:%s, longitude:%s}" % ( value["latitude"], value["longitude"] )
+        return value
+
+    def addSchema( self, statement ):
+        if statement not in self.schema:
+            self.schema.append( statement )
+
+    def close( self ):
+        for (kind, handle, writer, header) in self.files.values():
+            handle.close()
+
+        # Everything neo4j-admin needs (import.files alone, to add to another export's import.args), and
+        # the schema to apply once the database is up. Paths are absolute, so the import can run from anywhere
+        files = []
+        for (name, (kind, handle, writer, header)) in sorted( self.files.items() ):
+            path = os.path.abspath( os.path.join( self.directory, name ) )
+            files.append( f"--{kind}={path}.header.csv,{path}.csv\n" )
+
+        with open( os.path.join( self.directory, "import.files" ), "w" ) as args:
+            args.writelines( files )
+
+        with open( os.path.join( self.directory, "import.args" ), "w" ) as args:
+            # Token text can contain line breaks
+            args.write( "--multiline-fields=true\n" )
+            args.write( f"--array-delimiter=U+{ord( ARRAY_DELIMITER ):04X}\n" )
+            args.writelines( files )
+
+        with open( os.path.join( self.directory, "schema.cypher" ), "w" ) as schema:
+            for statement in self.schema:
+                schema.write( f"{statement};\n" )
+
+        for (name, count) in sorted( self.counts.items() ):
+            logger.info( f"Exported {count} rows to {name}.csv" )
@@ -0,0 +1,194 @@
+from loguru import logger
+import threading
+import random
+import json
+import time
+import re
+
+# Latency samples kept per statement for the percentiles
+SAMPLE_SIZE = 1000
+
+# Summary counters we add up per statement
+COUNTERS = [ "nodes_created", "nodes_deleted", "relationships_created", "relationships_deleted", "properties_set" ]
+
+
+def templateName( query ):
+    return re.sub( r"\s+", " ", query ).strip()
+
+
+class StatementStats:
+
+    def __init__( self ):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+        self.counters = dict.fromkeys( COUNTERS, 0 )
+
+    def add( self, elapsed, summary = None ):
+        self.count = self.count + 1
+        self.total = self.total + elapsed
+        self.max = max( self.max, elapsed )
+
+        # Reservoir sample, so memory stays fixed however many times a statement runs
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append( elapsed )
+        else:
+            slot = random.randrange( self.count )
+            if slot < SAMPLE_SIZE:
+                self.samples[slot] = elapsed
+
+        if summary is not None:
+            for name in COUNTERS:
+                self.counters[name] = self.counters[name] + getattr( summary.counters, name, 0 )
+
+    def percentile( self, p ):
+        if len(self.samples) == 0:
+            return 0.0
+        ordered = sorted( self.samples )
+        return ordered[ min( len(ordered) - 1, int( p / 100.0 * len(ordered) ) ) ]
+
+    def asDict( self ):
+        return dict( {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile( 50 ),
+            "p95": self.percentile( 95 ),
+            "p99": self.percentile( 99 ),
+            "max": self.max
+        }, **self.counters )
+
+
+class Instrumentation:
+    # Per statement template timings and result counters for everything sent through a driver. The
+    # async writer records from its own thread, so everything here happens under the lock
+
+    def __init__( self, name, path = None, interval = 0 ):
+        self.name = name
+        self.path = path
+        self.interval = interval
+        self.stats = {}
+        self.lastDump = time.monotonic()
+        self.lock = threading.RLock()
+
+    def record( self, template, elapsed, summary = None ):
+        with self.lock:
+            if template not in self.stats:
+                self.stats[template] = StatementStats()
+            self.stats[template].add( elapsed, summary )
+
+            if self.interval > 0 and time.monotonic() - self.lastDump > self.interval:
+                self.dump()
+
+    def dump( self ):
+        with self.lock:
+            self._dump()
+
+    def _dump( self ):
+        self.lastDump = time.monotonic()
+
+        logger.info( f"Statement stats for {self.name}:" )
+        logger.info( f"{'count':>9} {'total s':>9} {'mean ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'nodes+':>9} {'rels+':>9}  statement" )
+        for (template, stats) in sorted( self.stats.items(), key=lambda item: -item[1].total ):
+            s = stats.asDict()
+            logger.info(
+                f"{s['count']:>9} {s['total']:>9.2f} {s['mean'] * 1000:>9.2f} {s['p95'] * 1000:>9.2f} {s['p99'] * 1000:>9.2f} "
+                f"{s['nodes_created']:>9} {s['relationships_created']:>9}  {template[:100]}"
+            )
+
+        if self.path is not None:
+            self.export( self.path )
+
+    def export( self, path ):
+        # JSON for .json files, Prometheus text exposition format for anything else
+        if path.endswith( ".json" ):
+            with open( path, "w" ) as out:
+                json.dump( { "toolchain": self.name, "statements": { t: s.asDict() for (t, s) in self.stats.items() } }, out, indent=2 )
+            return
+
+        with open( path, "w" ) as out:
+            out.write( "# TYPE neobridge_statements_total counter\n" )
+            out.write( "# TYPE neobridge_statement_seconds summary\n" )
+            for name in COUNTERS:
+                out.write( f"# TYPE neobridge_{name}_total counter\n" )
+            for (template, stats) in self.stats.items():
+                s = stats.asDict()
+                labels = 'toolchain="{}",statement="{}"'.format( self.name, template.replace( "\\", "\\\\" ).replace( '"', '\\"' ) )
+                out.write( f"neobridge_statements_total{{{labels}}} {s['count']}\n" )
+                for q in [ 50, 95, 99 ]:
+                    out.write( f"neobridge_statement_seconds{{{labels},quantile=\"{q / 100.0}\"}} {s[f'p{q}']}\n" )
+                out.write( f"neobridge_statement_seconds_sum{{{labels}}} {s['total']}\n" )
+                out.write( f"neobridge_statement_seconds_count{{{labels}}} {s['count']}\n" )
+                for name in COUNTERS:
+                    out.write( f"neobridge_{name}_total{{{labels}}} {s[name]}\n" )
+
+
+class InstrumentedResult:
+    # Results are read eagerly, so the timing covers the whole round trip and we get the summary
+
+    def __init__( self, records, summary ):
+        self.records = records
+        self.summary = summary
+
+    def __iter__( self ):
+        return iter( self.records )
+
+    def single( self ):
+        return self.records[0] if len(self.records) > 0 else None
+
+    def data( self ):
+        return [ record.data() for record in self.records ]
+
+    def consume( self ):
+        return self.summary
+
+
+class InstrumentedDriver:
+
+    def __init__( self, driver, instrumentation ):
+        self.driver = driver
+        self.instrumentation = instrumentation
+
+    def session( self, **kwargs ):
+        return InstrumentedSession( self.driver.session( **kwargs ), self.instrumentation )
+
+    def close( self ):
+        self.driver.close()
+
+
+class InstrumentedSession:
+
+    def __init__( self, session, instrumentation ):
+        self.session = session
+        self.instrumentation = instrumentation
+
+    def run( self, query, parameters = None, **kwargs ):
+        start = time.perf_counter()
+        result = self.session.run( query, parameters, **kwargs )
+        records = list( result )
+        summary = result.consume()
+        self.instrumentation.record( templateName( query ), time.perf_counter() - start, summary )
+        return InstrumentedResult( records, summary )
+
+    def execute_write( self, work, *args, **kwargs ):
+        return self._execute( self.session.execute_write, work, *args, **kwargs )
+
+    def execute_read( self, work, *args, **kwargs ):
+        return self._execute( self.session.execute_read, work, *args, **kwargs )
+
+    def _execute( self, execute, work, *args, **kwargs ):
+        # Each statement is recorded as it runs; the whole transaction (retries and commit included) under the work's name
+        start = time.perf_counter()
+        result = execute( lambda tx: work( InstrumentedSession( tx, self.instrumentation ), *args, **kwargs ) )
+        self.instrumentation.record( f"transaction: {getattr( work, '__name__', 'work' )}", time.perf_counter() - start )
+        return result
+
+    def close( self ):
+        self.session.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.session.close()
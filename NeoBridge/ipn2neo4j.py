@@ -5,147 +5,223 @@ from optparse import OptionParser
 from neo4j import GraphDatabase
 import os
 import csv
-from NeoBridge import NeoBridge
+import itertools
+from NeoBridge import NeoBridge, CONCURRENCY
+from csvexport import stableUUID
+from spatial import toFloat
 
 parser = OptionParser()
 parser.add_option( "-i", "--input", dest="input", help="Read from a source .csv", metavar="FILE" )
+parser.add_option( "--batch-size", dest="batchSize", help="Write rows in batches of N (0 = one row at a time)", type="int", default=0 )
+parser.add_option( "--export", dest="export", help="Write neo4j-admin import CSVs to DIR instead of the database", metavar="DIR", default=None )
+parser.add_option( "--resume", dest="resume", help="Skip rows already written by a previous run on the same file", default=False, action="store_true" )
+parser.add_option( "--concurrency", dest="concurrency", help="Keep up to N batches in flight on an async driver (needs --batch-size; 0 = write synchronously)", type="int", default=CONCURRENCY )
+
+# Rows between checkpoints when writing one row at a time
+CHECKPOINT_ROWS = 1000
+
+# Place columns whose type can't be told from a first row without coordinates, for --export
+PLACE_TYPES = { "location": ":point{crs:WGS-84}" }
+
+# (column, label, set) for each of the optional county and district names
+PROPERTY_COLUMNS = [
+    ( 'CTYHISTNM', "County", "historic" ),
+    ( 'CTY61NM', "County", "1961" ),
+    ( 'CTY91NM', "County", "1991" ),
+    ( 'CTYLTNM', "County", "lieutenancy" ),
+    ( 'LAD61NM', "LocalAuthorityDistrict", "1961" ),
+    ( 'LAD91NM', "LocalAuthorityDistrict", "1991" )
+]
 
 class IPN2Neo4j(NeoBridge):
     
-    def __init__( self ):
-        super().__init__( name="ipn2neo4j", version="1.0.0" )
+    def __init__( self, export = None, concurrency = 0 ):
+        super().__init__( name="ipn2neo4j", version="1.0.0", export=export, concurrency=concurrency )
 
-        with self.driver.session() as session:
-            session.run( "CREATE INDEX placeIndex IF NOT EXISTS FOR (p:Place) ON (p.id)" )
+        self.schema( "CREATE INDEX placeIndex IF NOT EXISTS FOR (p:Place) ON (p.id)" )
+        self.schema( "CREATE POINT INDEX placeLocation IF NOT EXISTS FOR (p:Place) ON (p.location)" )
         
         self.addIndexedUUID( "Place" )
-        
+
+        # Places loaded before we stored points only have the raw lat/lon strings; backfill them once
+        if self.export is None and not self.getState( "locationsBackfilled", False ):
+            self.uow.autocommit(
+                "MATCH (p:Place) WHERE p.location IS NULL AND p.lat IS NOT NULL "
+                "CALL { WITH p SET p.location = point({latitude: toFloat(p.lat), longitude: toFloat(p.lon)}) } IN TRANSACTIONS OF 10000 ROWS"
+            )
+            self.setState( "locationsBackfilled", True )
+
+        self.addDimension( "DataSet", ["year", "toolchain"] )
+        self.addDimension( "PlaceNameDescriptor", ["code", "toolchain"] )
+        self.addDimension( "Country", ["name", "toolchain"] )
+        for prop in sorted( set( prop for (column, prop, propSet) in PROPERTY_COLUMNS ) ):
+            self.addDimension( prop, ["name", "set", "toolchain"] )
 
     def updateRow( self, header, row ):
+        if self.export is not None:
+            return self.updateRows( header, [row] )
+
         logger.info( f"Adding {getByColumn( 'PLACEID', header, row )}..." )
 
-        with self.driver.session() as session:
-            # Update the base node
-            session.run(
-                "MERGE (:Place {type: $type, lat: $lat, lon: $lon, id: $id, code: $code, name: $name, toolchain: $uuid})",
-                uuid=self.uuid,
-                type=getByColumn( 'DESCNM', header, row ),
-                lat=getByColumn( 'LAT', header, row ),
-                lon=getByColumn( 'LONG', header, row ),
-                id=getByColumn( 'PLACEID', header, row ),
-                code=getByColumn( 'PLACE22CD', header, row ),
-                name=getByColumn( 'PLACE22NM', header, row )
-            )
+        # Update the base node
+        self.uow.run(
+            "MERGE (p:Place {type: $type, lat: $lat, lon: $lon, id: $id, code: $code, name: $name, toolchain: $uuid}) "
+            "SET p.location = point({latitude: toFloat($lat), longitude: toFloat($lon)})",
+            uuid=self.uuid,
+            type=getByColumn( 'DESCNM', header, row ),
+            lat=getByColumn( 'LAT', header, row ),
+            lon=getByColumn( 'LONG', header, row ),
+            id=getByColumn( 'PLACEID', header, row ),
+            code=getByColumn( 'PLACE22CD', header, row ),
+            name=getByColumn( 'PLACE22NM', header, row )
+        )
 
-            # DataSet meta element (for timestamping the geo data)
-            session.run(
-                "MERGE (:DataSet {year: $year, toolchain: $uuid})",
-                uuid=self.uuid,
-                year=2023,
-                toolchain="ipn"
-            )
-            session.run(
-                "MATCH (pnd:DataSet {year: $year, toolchain: $uuid}), (p:Place {id:$id, toolchain: $uuid}) MERGE (p)-[:PartOf]->(pnd)",
-                uuid=self.uuid,
-                id=getByColumn( 'PLACEID', header, row ),
-                year=2023,
-            )
+        # DataSet meta element (for timestamping the geo data)
+        self.uow.run(
+            "MATCH (ds:DataSet {uuid: $ds}), (p:Place {id:$id, toolchain: $uuid}) MERGE (p)-[:PartOf]->(ds)",
+            uuid=self.uuid,
+            id=getByColumn( 'PLACEID', header, row ),
+            ds=self.dimension( "DataSet", year=2023, toolchain=self.uuid )
+        )
 
-            # Place Name Descriptor
-            session.run(
-                "MERGE (:PlaceNameDescriptor {code: $code, toolchain: $uuid})",
-                uuid=self.uuid,
-                code=getByColumn( 'DESCNM', header, row ),
-            )
-            session.run(
-                "MATCH (pnd:PlaceNameDescriptor {code: $code, toolchain: $uuid}), (p:Place {id:$id, toolchain: $uuid}) MERGE (pnd)-[:Describes]->(p)",
-                uuid=self.uuid,
-                id=getByColumn( 'PLACEID', header, row ),
-                code=getByColumn( 'DESCNM', header, row ),
-            )
+        # Place Name Descriptor
+        self.uow.run(
+            "MATCH (pnd:PlaceNameDescriptor {uuid: $pnd}), (p:Place {id:$id, toolchain: $uuid}) MERGE (pnd)-[:Describes]->(p)",
+            uuid=self.uuid,
+            id=getByColumn( 'PLACEID', header, row ),
+            pnd=self.dimension( "PlaceNameDescriptor", code=getByColumn( 'DESCNM', header, row ), toolchain=self.uuid )
+        )
 
-            # Country Name
-            session.run(
-                "MERGE (:Country {name: $name, toolchain: $uuid})",
-                uuid=self.uuid,
-                name=getByColumn( 'CTRY22NM', header, row ),
-            )
-            session.run(
-                "MATCH (pnd:Country {name: $name, toolchain: $uuid}), (p:Place {id:$id, toolchain: $uuid}) MERGE (pnd)-[:Describes]->(p)",
-                uuid=self.uuid,
-                id=getByColumn( 'PLACEID', header, row ),
-                name=getByColumn( 'CTRY22NM', header, row ),
-            )
+        # Country Name
+        self.uow.run(
+            "MATCH (c:Country {uuid: $c}), (p:Place {id:$id, toolchain: $uuid}) MERGE (c)-[:Describes]->(p)",
+            uuid=self.uuid,
+            id=getByColumn( 'PLACEID', header, row ),
+            c=self.dimension( "Country", name=getByColumn( 'CTRY22NM', header, row ), toolchain=self.uuid )
+        )
 
-            # Historic county name
-            if getByColumn( 'CTYHISTNM', header, row ) != "":
+        # County and Local Authority District names
+        for (column, prop, propSet) in PROPERTY_COLUMNS:
+            if getByColumn( column, header, row ) != "":
                 self.addProperty(
-                    _prop = "County",
+                    _prop = prop,
                     _id   = getByColumn( 'PLACEID', header, row ),
-                    _set  = "historic",
-                    _name = getByColumn( 'CTYHISTNM', header, row )
+                    _set  = propSet,
+                    _name = getByColumn( column, header, row )
                 )
 
-            # 1961 county name
-            if getByColumn( 'CTY61NM', header, row ) != "":
-                self.addProperty(
-                    _prop = "County",
-                    _id   = getByColumn( 'PLACEID', header, row ),
-                    _set  = "1961",
-                    _name = getByColumn( 'CTY61NM', header, row )
-                )
+    def updateRows( self, header, rows ):
+        logger.info( f"Adding batch of {len(rows)} rows, from {getByColumn( 'PLACEID', header, rows[0] )}..." )
 
-            # 1991 county name
-            if getByColumn( 'CTY91NM', header, row ) != "":
-                self.addProperty(
-                    _prop = "County",
-                    _id   = getByColumn( 'PLACEID', header, row ),
-                    _set  = "1991",
-                    _name = getByColumn( 'CTY91NM', header, row )
-                )
+        places = []
+        properties = {}
+        for row in rows:
+            places.append( {
+                "type": getByColumn( 'DESCNM', header, row ),
+                "lat": getByColumn( 'LAT', header, row ),
+                "lon": getByColumn( 'LONG', header, row ),
+                "id": getByColumn( 'PLACEID', header, row ),
+                "code": getByColumn( 'PLACE22CD', header, row ),
+                "name": getByColumn( 'PLACE22NM', header, row ),
+                "country": getByColumn( 'CTRY22NM', header, row )
+            } )
 
-            # Lieutenancy County Name
-            if getByColumn( 'CTYLTNM', header, row ) != "":
-                self.addProperty(
-                    _prop = "County",
-                    _id   = getByColumn( 'PLACEID', header, row ),
-                    _set  = "lieutenancy",
-                    _name = getByColumn( 'CTYLTNM', header, row )
-                )
+            for (column, prop, propSet) in PROPERTY_COLUMNS:
+                if getByColumn( column, header, row ) != "":
+                    properties.setdefault( prop, [] ).append( {
+                        "id": getByColumn( 'PLACEID', header, row ),
+                        "set": propSet,
+                        "name": getByColumn( column, header, row ),
+                        "toolchain": self.uuid
+                    } )
 
-            # 1961 Local Authority District Name
-            if getByColumn( 'LAD61NM', header, row ) != "":
-                self.addProperty(
-                    _prop = "LocalAuthorityDistrict",
-                    _id   = getByColumn( 'PLACEID', header, row ),
-                    _set  = "1961",
-                    _name = getByColumn( 'LAD61NM', header, row )
-                )
+        # Resolve the dimension nodes up front, so the write only has to link to them
+        for (place, pnd, country) in zip(
+            places,
+            self.resolveDimensions( "PlaceNameDescriptor", [ { "code": place["type"], "toolchain": self.uuid } for place in places ] ),
+            self.resolveDimensions( "Country", [ { "name": place["country"], "toolchain": self.uuid } for place in places ] )
+        ):
+            place["pnd"] = pnd
+            place["country"] = country
 
-            # 1991 Local Authority District Name
-            if getByColumn( 'LAD91NM', header, row ) != "":
-                self.addProperty(
-                    _prop = "LocalAuthorityDistrict",
-                    _id   = getByColumn( 'PLACEID', header, row ),
-                    _set  = "1991",
-                    _name = getByColumn( 'LAD91NM', header, row )
-                )
-    
-    def addProperty( self, _prop, _id, _set, _name, _propName = "name" ):
-        with self.driver.session() as session:
-            session.run(
-                "MERGE (:" +_prop+ " {" +_propName+ ": $name, set: $set, toolchain: $uuid})",
-                uuid=self.uuid,
-                set=_set,
-                name=_name
-            )
-            session.run(
-                "MATCH (prop:" +_prop+ " {" +_propName+ ": $name, set: $set, toolchain: $uuid}), (p:Place {id:$id}) MERGE (prop)-[:Describes]->(p)",
-                uuid=self.uuid,
-                id=_id,
-                set=_set,
-                name=_name
+        for (prop, rows) in properties.items():
+            for (row, propUUID) in zip( rows, self.resolveDimensions( prop, rows ) ):
+                row["prop"] = propUUID
+
+        dataSet = self.dimension( "DataSet", year=2023, toolchain=self.uuid )
+
+        if self.export is not None:
+            self._exportRows( places, properties, dataSet )
+            return
+
+        return self.write( self._rowStatements, places, properties, dataSet )
+
+    def _exportRows( self, places, properties, dataSet ):
+        placeUUIDs = {}
+        for place in places:
+            props = { k: place[k] for k in ["type", "lat", "lon", "id", "code", "name"] }
+            props["toolchain"] = self.uuid
+            placeUUID = stableUUID( "Place", *[ props[k] for k in sorted( props.keys() ) ] )
+
+            # Always present (empty without coordinates), since the first Place fixes the file's columns
+            (lat, lon) = (toFloat( place["lat"] ), toFloat( place["lon"] ))
+            props["location"] = None
+            if lat is not None and lon is not None:
+                props["location"] = { "latitude": lat, "longitude": lon }
+
+            # Duplicate rows would have been merged, so only link new places
+            if not self.export.node( "Place", placeUUID, props, types=PLACE_TYPES ):
+                continue
+            placeUUIDs[place["id"]] = placeUUID
+            self.points.add( placeUUID, place["name"], place["lat"], place["lon"] )
+            self.export.relationship( "PartOf", placeUUID, dataSet )
+            self.export.relationship( "Describes", place["pnd"], placeUUID )
+            self.export.relationship( "Describes", place["country"], placeUUID )
+
+        for rows in properties.values():
+            for row in rows:
+                if row["id"] in placeUUIDs:
+                    self.export.relationship( "Describes", row["prop"], placeUUIDs[row["id"]] )
+
+    def _rowStatements( self, places, properties, dataSet ):
+        # Update the base nodes
+        yield (
+            "UNWIND $rows AS row MERGE (p:Place {type: row.type, lat: row.lat, lon: row.lon, id: row.id, code: row.code, name: row.name, toolchain: $uuid}) "
+            "SET p.location = point({latitude: toFloat(row.lat), longitude: toFloat(row.lon)})",
+            { "uuid": self.uuid, "rows": places }
+        )
+
+        # DataSet meta element (for timestamping the geo data)
+        yield (
+            "MATCH (ds:DataSet {uuid: $ds}) UNWIND $rows AS row MATCH (p:Place {id: row.id, toolchain: $uuid}) MERGE (p)-[:PartOf]->(ds)",
+            { "uuid": self.uuid, "ds": dataSet, "rows": places }
+        )
+
+        # Place Name Descriptor
+        yield (
+            "UNWIND $rows AS row MATCH (pnd:PlaceNameDescriptor {uuid: row.pnd}), (p:Place {id: row.id, toolchain: $uuid}) MERGE (pnd)-[:Describes]->(p)",
+            { "uuid": self.uuid, "rows": places }
+        )
+
+        # Country Name
+        yield (
+            "UNWIND $rows AS row MATCH (c:Country {uuid: row.country}), (p:Place {id: row.id, toolchain: $uuid}) MERGE (c)-[:Describes]->(p)",
+            { "uuid": self.uuid, "rows": places }
+        )
+
+        # County and Local Authority District names, one statement per label
+        for (prop, rows) in properties.items():
+            yield (
+                "UNWIND $rows AS row MATCH (prop:" +prop+ " {uuid: row.prop}), (p:Place {id: row.id}) MERGE (prop)-[:Describes]->(p)",
+                { "rows": rows }
             )
+
+    def addProperty( self, _prop, _id, _set, _name, _propName = "name" ):
+        self.uow.run(
+            "MATCH (prop:" +_prop+ " {uuid: $prop}), (p:Place {id:$id}) MERGE (prop)-[:Describes]->(p)",
+            id=_id,
+            prop=self.dimension( _prop, **{ _propName: _name, "set": _set, "toolchain": self.uuid } )
+        )
         
     
 
@@ -162,7 +238,7 @@ def getByColumn( field, headings, row, default = None ):
 if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
-    db = IPN2Neo4j()
+    db = IPN2Neo4j( export=options.export, concurrency=options.concurrency if options.batchSize > 0 else 0 )
 
     logger.info( "ID for IPN Tooling: " + str(db.uuid) )
 
@@ -174,5 +250,35 @@ if __name__ == "__main__":
 
         logger.info( header )
 
-        for row in ipnReader:
-            db.updateRow( header, row )
\ No newline at end of file
+        # Rows already written are tracked per input file on our Toolchain node
+        checkpoint = f"checkpoint:{os.path.abspath( options.input )}"
+        rowsDone = 0
+        if options.resume:
+            rowsDone = db.getState( checkpoint, 0 )
+            logger.info( f"Resuming after row {rowsDone}" )
+            for row in itertools.islice( ipnReader, rowsDone ):
+                pass
+
+        if options.batchSize > 0:
+            batch = []
+            for row in ipnReader:
+                batch.append( row )
+                if len(batch) >= options.batchSize:
+                    db.updateRows( header, batch )
+                    rowsDone = rowsDone + len(batch)
+                    db.afterWrites( db.setState, checkpoint, rowsDone )
+                    batch = []
+
+            if len(batch) > 0:
+                db.updateRows( header, batch )
+                rowsDone = rowsDone + len(batch)
+        else:
+            for row in ipnReader:
+                db.updateRow( header, row )
+                rowsDone = rowsDone + 1
+                if rowsDone % CHECKPOINT_ROWS == 0:
+                    db.setState( checkpoint, rowsDone )
+
+        db.afterWrites( db.setState, checkpoint, rowsDone )
+
+    db.close()
@@ -3,63 +3,231 @@
 from loguru import logger
 from optparse import OptionParser
 from NeoBridge import NeoBridge
+from placematch import PlaceMatcher
 
 parser = OptionParser()
 parser.add_option( "-i", "--input", dest="input", help="Read from a source .csv", metavar="FILE" )
+parser.add_option( "--full", dest="full", help="Relink everything, not just nodes added since the last run", default=False, action="store_true" )
+parser.add_option( "--fuzzy", dest="fuzzy", help="Also link near matches scoring at least SCORE (0-1, e.g. 0.85; 0 = exact only)", metavar="SCORE", type="float", default=0 )
+parser.add_option( "--proximity", dest="proximity", help="Resolve mentions of ambiguous place names by distance to the other places in the same paragraph", default=False, action="store_true" )
+
+# Node labels that can be the target of a link, keyed on their lowercased name
+LINK_TARGETS = [ "Place", "County", "LocalAuthorityDistrict", "PlaceNameDescriptor" ]
+
+# (label, condition, relationship) for each kind of node we link from
+LINK_SOURCES = [
+    ( "Entity", "s.type <> 'PERSON'", "Is" ),
+    ( "Entity", "s.type = 'PERSON'", "Homophone" ),
+    ( "Lemma", "true", "Matches" )
+]
+
+# Rows per inner transaction for the key and link passes
+LINK_BATCH = 10000
+
+# Paragraphs per proximity pass, and how far from a paragraph's other places we look for an ambiguous one
+PROXIMITY_BATCH = 1000
+PROXIMITY_METRES = 50000
 
 class CorpusLinker(NeoBridge):
     
     def __init__( self ):
         super().__init__( name="corpuslinker", version="1.0.0" )
 
-    def tryLinking( self ):
-        with self.driver.session() as session:
-            # Attempt to match any existing name-entities in the database...
-            logger.info( "Attempting to match any Place->Entity similarities..." )
-            session.run( "MATCH (p:Place), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type <> 'PERSON' MERGE (e)-[:Is]->(p)" )
-            session.run( "MATCH (p:Place), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type = 'PERSON' MERGE (e)-[:Homophone]->(p)" )
-            session.close()
-        
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any Place->Lemma similarities..." )
-            session.run( "MATCH (p:Place), (l:Lemma) WHERE toLower(l.text) = toLower(p.name) MERGE (l)-[:Matches]->(p)" )
-            session.close()
-
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any County->Entity similarities..." )
-            session.run( "MATCH (p:County), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type <> 'PERSON' MERGE (e)-[:Is]->(p)" )
-            session.run( "MATCH (p:County), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type = 'PERSON' MERGE (e)-[:Homophone]->(p)" )
-            session.close()
-
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any County->Lemma similarities..." )
-            session.run( "MATCH (p:County), (l:Lemma) WHERE toLower(l.text) = toLower(p.name) MERGE (l)-[:Matches]->(p)" )
-            session.close()
-
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any LocalAuthorityDistrict->Entity similarities..." )
-            session.run( "MATCH (p:LocalAuthorityDistrict), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type <> 'PERSON' MERGE (e)-[:Is]->(p)" )
-            session.run( "MATCH (p:LocalAuthorityDistrict), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type = 'PERSON' MERGE (e)-[:Homophone]->(p)" )
-            session.close()
-
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any LocalAuthorityDistrict->Lemma similarities..." )
-            session.run( "MATCH (p:LocalAuthorityDistrict), (l:Lemma) WHERE toLower(l.text) = toLower(p.name) MERGE (l)-[:Matches]->(p)" )
-            session.close()
-
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any PlaceNameDescriptor->Entity similarities..." )
-            session.run( "MATCH (p:PlaceNameDescriptor), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type <> 'PERSON' MERGE (e)-[:Is]->(p)" )
-            session.run( "MATCH (p:PlaceNameDescriptor), (e:Entity) WHERE toLower(e.text) = toLower(p.name) AND e.type = 'PERSON' MERGE (e)-[:Homophone]->(p)" )
-            session.close()
-
-        with self.driver.session() as session:
-            logger.info( "Attempting to match any PlaceNameDescriptor->Lemma similarities..." )
-            session.run( "MATCH (p:PlaceNameDescriptor), (l:Lemma) WHERE toLower(l.text) = toLower(p.name) MERGE (l)-[:Matches]->(p)" )
-            session.close()
+        for label in LINK_TARGETS:
+            self.schema( f"CREATE INDEX {label[0].lower() + label[1:]}NameKey IF NOT EXISTS FOR (n:{label}) ON (n.nameKey)" )
+        self.schema( "CREATE INDEX entityTextKey IF NOT EXISTS FOR (e:Entity) ON (e.textKey)" )
+        self.schema( "CREATE INDEX lemmaTextKey IF NOT EXISTS FOR (l:Lemma) ON (l.textKey)" )
+        for label in LINK_TARGETS + [ "Entity", "Lemma" ]:
+            self.schema( f"CREATE INDEX {label[0].lower() + label[1:]}KeyedAt IF NOT EXISTS FOR (n:{label}) ON (n.keyedAt)" )
+        self.schema( "CREATE INDEX paragraphWrittenAt IF NOT EXISTS FOR (p:Paragraph) ON (p.writtenAt)" )
+
+    def updateKeys( self ):
+        # Materialise the normalised lookup keys, so the joins below are index seeks.
+        # Anything new or renamed gets (re)keyed and stamped with keyedAt
+        logger.info( "Updating lookup keys..." )
+        for label in LINK_TARGETS:
+            self.uow.autocommit( self._keyQuery( label, "name", "nameKey" ) )
+        self.uow.autocommit( self._keyQuery( "Entity", "text", "textKey" ) )
+        self.uow.autocommit( self._keyQuery( "Lemma", "text", "textKey" ) )
+
+    @staticmethod
+    def _keyQuery( label, prop, key ):
+        return (
+            f"MATCH (n:{label}) WHERE n.{prop} IS NOT NULL AND (n.{key} IS NULL OR n.{key} <> toLower(n.{prop})) "
+            f"CALL {{ WITH n SET n.{key} = toLower(n.{prop}), n.keyedAt = timestamp() }} IN TRANSACTIONS OF {LINK_BATCH} ROWS"
+        )
+
+    def tryLinking( self, full = False, fuzzy = 0, proximity = False ):
+        since = None if full else self.getState( "lastLinked" )
+        if since is None:
+            logger.info( "Linking everything..." )
+        else:
+            logger.info( f"Linking nodes keyed since {since}..." )
+
+        self.updateKeys()
+
+        # Only updateKeys sets keyedAt, so everything keyed from here on belongs to the next run
+        keyedTo = self.uow.fetch( "RETURN timestamp()" )[0][0]
+
+        for label in LINK_TARGETS:
+            for (source, where, rel) in LINK_SOURCES:
+                # Attempt to match any existing name-entities in the database...
+                logger.info( f"Attempting to match any {label}->{source} similarities ({rel})..." )
+                self.uow.autocommit(
+                    f"MATCH (s:{source}) WHERE s.textKey IS NOT NULL AND {where} "
+                    + ( "" if since is None else "AND s.keyedAt >= $since " )
+                    + f"CALL {{ WITH s MATCH (p:{label} {{nameKey: s.textKey}}) MERGE (s)-[:{rel}]->(p) }} IN TRANSACTIONS OF {LINK_BATCH} ROWS",
+                    since = since
+                )
+
+                # ...and any new or renamed targets against all existing sources
+                if since is not None:
+                    self.uow.autocommit(
+                        f"MATCH (p:{label}) WHERE p.keyedAt >= $since "
+                        f"CALL {{ WITH p MATCH (s:{source} {{textKey: p.nameKey}}) WHERE {where} MERGE (s)-[:{rel}]->(p) }} IN TRANSACTIONS OF {LINK_BATCH} ROWS",
+                        since = since
+                    )
+
+        if fuzzy > 0:
+            self.fuzzyLinking( fuzzy, since )
+
+        if proximity:
+            self.proximityLinking( since )
+
+        self.setState( "lastLinked", keyedTo + 1 )
+
+    def fuzzyLinking( self, threshold, since = None ):
+        # Variant spellings ("St. Albans", "Newcastle-upon-Tyne") matched client-side against every
+        # target name, written as links carrying a score
+        matcher = PlaceMatcher( threshold )
+        changed = False
+        for label in LINK_TARGETS:
+            res = self.uow.fetch( f"MATCH (n:{label}) WHERE n.name IS NOT NULL RETURN n.uuid, n.name, n.keyedAt" )
+            for record in res:
+                matcher.add( label, record[0], record[1] )
+                changed = changed or since is None or (record[2] is not None and record[2] >= since)
+        logger.info( f"Loaded {len(matcher)} distinct target names for fuzzy matching" )
+
+        # Any new or renamed target could match an old source, so only skip old sources if nothing changed
+        if changed:
+            since = None
+
+        for (source, where, rel) in LINK_SOURCES:
+            logger.info( f"Fuzzy matching {source} ({rel}) at >= {threshold}..." )
+            links = {}
+            (matched, candidates) = (0, 0)
+            for page in self._sourcePages( source, where, since ):
+                candidates = candidates + len(page)
+                for record in page:
+                    for (label, targetUUID, score) in matcher.match( record[1] ):
+                        batch = links.setdefault( label, [] )
+                        batch.append( { "s": record[0], "p": targetUUID, "score": score } )
+                        matched = matched + 1
+                        if len(batch) >= LINK_BATCH:
+                            self._writeScoredLinks( source, label, rel, batch )
+                            links[label] = []
+
+            for (label, batch) in links.items():
+                if len(batch) > 0:
+                    self._writeScoredLinks( source, label, rel, batch )
+            logger.info( f"Linked {matched} {source} matches from {candidates} candidates" )
+
+    def _sourcePages( self, source, where, since ):
+        # LINK_BATCH sources at a time, in uuid order (so each page is a seek on the uuid constraint)
+        after = ""
+        while True:
+            page = self.uow.fetch(
+                f"MATCH (s:{source}) WHERE s.uuid > $after AND s.text IS NOT NULL AND {where} "
+                + ( "" if since is None else "AND s.keyedAt >= $since " )
+                + "RETURN s.uuid, s.text ORDER BY s.uuid LIMIT $limit",
+                after = after,
+                since = since,
+                limit = LINK_BATCH
+            )
+            if len(page) == 0:
+                return
+            yield page
+            after = page[-1][0]
+
+    def proximityLinking( self, since = None ):
+        # Paragraphs written since the last run (every paragraph, the first time), a page at a time
+        (resolved, paragraphs) = (0, 0)
+        after = ""
+        while True:
+            page = self.uow.fetch(
+                "MATCH (para:Paragraph) WHERE para.uuid > $after "
+                + ( "" if since is None else "AND para.writtenAt >= $since " )
+                + "RETURN para.uuid, para.source, para.index ORDER BY para.uuid LIMIT $limit",
+                after = after,
+                since = since,
+                limit = PROXIMITY_BATCH
+            )
+            if len(page) == 0:
+                break
+            after = page[-1][0]
+            paragraphs = paragraphs + len(page)
+            resolved = resolved + self._resolvePage( [ [record[1], record[2]] for record in page ] )
+
+        logger.info( f"Resolved {resolved} ambiguous place mentions in {paragraphs} paragraphs" )
+
+    def _resolvePage( self, paragraphs ):
+        # One row per place-named entity per paragraph, with every place its name links to
+        res = self.uow.fetch(
+            "UNWIND $paragraphs AS para "
+            "MATCH (t:Token {source: para[0], paragraph: para[1]})-[:Is]->(e:Entity)-[:Is]->(p:Place) WHERE p.location IS NOT NULL "
+            "RETURN para[0], para[1], e.uuid, min(t.index), collect(DISTINCT [p.uuid, p.location.latitude, p.location.longitude])",
+            paragraphs = paragraphs
+        )
+
+        mentions = {}
+        for record in res:
+            mentions.setdefault( (record[0], record[1]), [] ).append( (record[3], record[4]) )
+
+        # Names only one place has anchor the paragraph; each ambiguous name goes to whichever of its
+        # places the point index finds nearest an anchor
+        nearby = {}
+        rows = []
+        for ((source, paragraph), found) in mentions.items():
+            anchors = [ candidates[0] for (index, candidates) in found if len(candidates) == 1 ]
+            for (index, candidates) in found:
+                if len(candidates) < 2 or len(anchors) == 0:
+                    continue
+
+                wanted = set( candidate[0] for candidate in candidates )
+                best = None
+                for (anchor, lat, lon) in anchors:
+                    if anchor not in nearby:
+                        nearby[anchor] = self.placesWithin( lat, lon, PROXIMITY_METRES )
+                    for (place, name, pLat, pLon, metres) in nearby[anchor]:
+                        if place in wanted:
+                            if best is None or metres < best[1]:
+                                best = (place, metres)
+                            break
+
+                if best is not None:
+                    rows.append( { "source": source, "paragraph": paragraph, "index": index, "place": best[0], "distance": best[1] } )
+
+        if len(rows) > 0:
+            self._writeMentions( rows )
+        return len(rows)
+
+    def _writeMentions( self, rows ):
+        self.uow.run(
+            "UNWIND $rows AS row MATCH (t:Token {source: row.source, paragraph: row.paragraph, index: row.index}), (p:Place {uuid: row.place}) "
+            "MERGE (t)-[r:Mentions]->(p) SET r.distance = row.distance",
+            rows = rows
+        )
+
+    def _writeScoredLinks( self, source, label, rel, rows ):
+        self.uow.run(
+            f"UNWIND $rows AS row MATCH (s:{source} {{uuid: row.s}}), (p:{label} {{uuid: row.p}}) "
+            f"MERGE (s)-[r:{rel}]->(p) SET r.score = row.score",
+            rows = rows
+        )
 
 if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     db = CorpusLinker()
-    db.tryLinking()
+    db.tryLinking( full=options.full, fuzzy=options.fuzzy, proximity=options.proximity )
+    db.close()
@@ -0,0 +1,97 @@
+from loguru import logger
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+from spacy.attrs import LANG
+import sqlite3
+import time
+import os
+
+# Token attributes we keep; custom extensions (pymusas tags) travel in user_data
+DOC_ATTRS = [ "ORTH", "NORM", "LEMMA", "TAG", "POS", "MORPH", "HEAD", "DEP", "ENT_IOB", "ENT_TYPE", "ENT_KB_ID", "SENT_START" ]
+
+# Commit the cache's bookkeeping every this many operations
+COMMIT_EVERY = 100
+
+
+class ParseCache:
+    # Serialised DocBin parses in a local SQLite file, keyed by the caller (text hash plus models),
+    # kept under maxBytes by evicting whatever was least recently used
+
+    def __init__( self, directory, maxBytes ):
+        os.makedirs( directory, exist_ok=True )
+        self.path = os.path.join( directory, "parses.sqlite" )
+        self.maxBytes = maxBytes
+
+        self.db = sqlite3.connect( self.path )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, data BLOB, size INTEGER, used REAL, lang TEXT)" )
+        self.db.execute( "CREATE INDEX IF NOT EXISTS parsesUsed ON parses (used)" )
+
+        # Caches from before we kept the language; their rows count as misses until they're replaced
+        if "lang" not in [ column[1] for column in self.db.execute( "PRAGMA table_info(parses)" ) ]:
+            self.db.execute( "ALTER TABLE parses ADD COLUMN lang TEXT" )
+
+        # Cached parses are rebuilt on a vocab of their own, so reading them never needs the model loaded
+        self.vocabs = {}
+        self.size = self.db.execute( "SELECT coalesce(sum(size), 0) FROM parses" ).fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.ops = 0
+        logger.info( f"Parse cache {self.path}: {self.size / 1e6:.1f} of {self.maxBytes / 1e6:.1f} MB used" )
+
+    def __contains__( self, key ):
+        return self.db.execute( "SELECT 1 FROM parses WHERE key = ? AND lang IS NOT NULL", (key,) ).fetchone() is not None
+
+    def get( self, key ):
+        row = self.db.execute( "SELECT data, lang FROM parses WHERE key = ? AND lang IS NOT NULL", (key,) ).fetchone()
+        if row is None:
+            self.misses = self.misses + 1
+            return None
+
+        self.hits = self.hits + 1
+        self.db.execute( "UPDATE parses SET used = ? WHERE key = ?", (time.time(), key) )
+        self._tick()
+        return next( DocBin( store_user_data=True ).from_bytes( row[0] ).get_docs( self._vocab( row[1] ) ) )
+
+    def _vocab( self, lang ):
+        # DocBin carries its own strings; the vocab only has to answer doc.lang_
+        if lang not in self.vocabs:
+            self.vocabs[lang] = Vocab( lex_attr_getters={ LANG: lambda string: lang } )
+        return self.vocabs[lang]
+
+    def put( self, key, doc ):
+        data = DocBin( attrs=DOC_ATTRS, store_user_data=True, docs=[doc] ).to_bytes()
+        if len(data) > self.maxBytes:
+            return
+
+        old = self.db.execute( "SELECT size FROM parses WHERE key = ?", (key,) ).fetchone()
+        self.db.execute(
+            "INSERT OR REPLACE INTO parses (key, data, size, used, lang) VALUES (?, ?, ?, ?, ?)",
+            (key, data, len(data), time.time(), doc.lang_)
+        )
+        self.size = self.size + len(data) - (old[0] if old else 0)
+
+        if self.size > self.maxBytes:
+            self._evict()
+        self._tick()
+
+    def _evict( self ):
+        # Down to 90%, so we aren't evicting on every put
+        target = self.maxBytes * 0.9
+        for (key, size) in self.db.execute( "SELECT key, size FROM parses ORDER BY used" ).fetchall():
+            if self.size <= target:
+                break
+            self.db.execute( "DELETE FROM parses WHERE key = ?", (key,) )
+            self.size = self.size - size
+            self.evicted = self.evicted + 1
+
+    def _tick( self ):
+        self.ops = self.ops + 1
+        if self.ops % COMMIT_EVERY == 0:
+            self.db.commit()
+
+    def close( self ):
+        self.db.commit()
+        self.db.close()
+        logger.info( f"Parse cache: {self.hits} hits, {self.misses} misses, {self.evicted} evicted, {self.size / 1e6:.1f} MB" )
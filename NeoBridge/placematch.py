@@ -0,0 +1,113 @@
+from collections import defaultdict
+import unicodedata
+import re
+
+# Word variants folded together before matching ("St. Albans" / "Saint Albans")
+ABBREVIATIONS = {
+    "st": "saint",
+    "ste": "sainte",
+    "mt": "mount",
+    "ft": "fort",
+    "gt": "great",
+    "lt": "little",
+    "and": "&"
+}
+
+# Grams shared by more than this many names ("ton", " sa") say little, so aren't used to find candidates
+# (they still count when scoring them)
+MAX_POSTINGS = 5000
+
+# Matches remembered per normalised text, before the memo is started afresh
+MEMO_SIZE = 100000
+
+
+def normalise( text ):
+    # Lowercase, strip diacritics and apostrophes ("King's" / "Kings"), fold other punctuation
+    # (hyphens, dots) to single spaces
+    text = unicodedata.normalize( "NFKD", text )
+    text = "".join( c for c in text if not unicodedata.combining( c ) ).lower()
+    text = re.sub( r"['’]", "", text )
+    text = re.sub( r"[^\w&]+", " ", text )
+    return " ".join( ABBREVIATIONS.get( word, word ) for word in text.split() )
+
+
+def trigrams( key ):
+    padded = f"  {key} "
+    return set( padded[i:i + 3] for i in range( len(padded) - 2 ) )
+
+
+class PlaceMatcher:
+    # In-memory gazetteer: names are normalised, then looked up exactly or by trigram (Dice) similarity.
+    # Results are memoised per normalised text, since the same entity texts come up again and again
+
+    def __init__( self, threshold = 0.8, limit = 5 ):
+        self.threshold = threshold
+        self.limit = limit
+
+        self.keys = []
+        self.grams = []
+        self.targets = []
+        self.keyIndex = {}
+        self.postings = defaultdict( list )
+        self.memo = {}
+
+    def add( self, label, nodeUUID, name ):
+        key = normalise( name )
+        if key == "":
+            return
+
+        if key not in self.keyIndex:
+            self.keyIndex[key] = len(self.keys)
+            grams = frozenset( trigrams( key ) )
+            for gram in grams:
+                self.postings[gram].append( len(self.keys) )
+            self.keys.append( key )
+            self.grams.append( grams )
+            self.targets.append( [] )
+
+        self.targets[self.keyIndex[key]].append( (label, nodeUUID) )
+        self.memo = {}
+
+    def __len__( self ):
+        return len(self.keys)
+
+    def match( self, text ):
+        # [(label, uuid, score)] for the best `limit` names scoring at least `threshold`
+        key = normalise( text )
+        if key not in self.memo:
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo = {}
+            self.memo[key] = self._match( key )
+        return self.memo[key]
+
+    def _match( self, key ):
+        if key == "":
+            return []
+
+        if key in self.keyIndex:
+            return [ (label, nodeUUID, 1.0) for (label, nodeUUID) in self.targets[self.keyIndex[key]] ]
+
+        grams = trigrams( key )
+        size = len(grams)
+
+        # Dice >= t needs the other name's gram count within these bounds
+        low = size * self.threshold / (2 - self.threshold)
+        high = size * (2 - self.threshold) / self.threshold
+
+        # Candidates share at least one of our rarer grams; each is then scored on its full gram set
+        candidates = set()
+        for gram in grams:
+            posting = self.postings.get( gram )
+            if posting is not None and len(posting) <= MAX_POSTINGS:
+                candidates.update( posting )
+
+        scored = []
+        for i in candidates:
+            other = self.grams[i]
+            if low <= len(other) <= high:
+                score = 2.0 * len(grams & other) / (size + len(other))
+                if score >= self.threshold:
+                    scored.append( (score, i) )
+
+        scored.sort( reverse=True )
+        return [ (label, nodeUUID, round( score, 3 )) for (score, i) in scored[:self.limit] for (label, nodeUUID) in self.targets[i] ]
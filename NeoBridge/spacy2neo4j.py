@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
 
-from email.policy import default
 from optparse import OptionParser
 from neo4j import GraphDatabase
-from NeoBridge import NeoBridge
+from NeoBridge import NeoBridge, CONCURRENCY
+from unitofwork import runStatements
+from collections import Counter
+from itertools import combinations
+from csvexport import stableUUID
 from loguru import logger
 import xml.etree.ElementTree as ET
-import spacy
-from spacy import displacy
-from spacy import tokenizer
+import importlib.metadata
+import itertools
+import time
 import os
-import sys
+import queue
+import threading
+import hashlib
+
+# Components that only feed outputs we might not have been asked for; nothing reads the parser's dependencies
+TAGGING_COMPONENTS = [ "tagger", "morphologizer", "attribute_ruler", "lemmatizer" ]
+ENTITY_COMPONENTS = [ "ner", "entity_ruler", "entity_linker" ]
+UNUSED_COMPONENTS = [ "parser" ]
+
+# Compact paragraph arrays whose type can't be told from an empty first value, for --export
+PARAGRAPH_TYPES = { "tokenOffsets": ":long[]", "pymusasTokens": ":long[]" }
+
+# Most recently used entities kept resolved in memory
+ENTITY_CACHE = 200000
+
+# Most paragraphs held back behind an uncached one with --parse-cache, before its chunk is parsed
+PARSE_CHUNK = 1000
 
 parser = OptionParser()
 parser.add_option( "--xml", dest="inputXML", help="Read from a source .xml", metavar="FILE", default=None )
@@ -18,147 +37,477 @@ parser.add_option( "--txt", dest="inputTXT", help="Read from a source .txt", met
 parser.add_option( "--model", dest="spacy_data", help="Set the spacy training data to use", default="en_core_web_lg" )
 parser.add_option( "--tokens", dest="doTokens", help="Insert tokens into the database", default=False, action="store_true" )
 parser.add_option( "--entities", dest="doEntities", help="Insert entity spans into the database", default=False, action="store_true" )
+parser.add_option( "--compact", dest="compact", help="Store each paragraph's tokens as arrays on one Paragraph node, rather than a node per token", default=False, action="store_true" )
+parser.add_option( "--aggregates", dest="doAggregates", help="Keep lemma, tag and entity counts per paragraph and source, and entity co-occurrence counts (not exported)", default=False, action="store_true" )
 parser.add_option( "--pymusas", dest="doPymusas", help="Include pymusas annotations", default=False, action="store_true" )
 parser.add_option( "--pymusas-model", dest="pymusas_data", help="Set the pymusas model to use", default="en_dual_none_contextual" )
+parser.add_option( "--export", dest="export", help="Write neo4j-admin import CSVs to DIR instead of the database", metavar="DIR", default=None )
+parser.add_option( "--resume", dest="resume", help="Skip paragraphs already written by a previous run", default=False, action="store_true" )
+parser.add_option( "--skip-unchanged", dest="skipUnchanged", help="Skip paragraphs whose text, model and options match what was last written", default=False, action="store_true" )
+parser.add_option( "--parse-cache", dest="parseCache", help="Keep parses in DIR and reuse them for the same text and models", metavar="DIR", default=None )
+parser.add_option( "--parse-cache-size", dest="parseCacheSize", help="Maximum size of the parse cache in MB", type="int", default=1024 )
+parser.add_option( "--max-chunk", dest="maxChunk", help="Split .txt paragraphs longer than this many characters", type="int", default=10000 )
+parser.add_option( "--batch-size", dest="batchSize", help="Number of paragraphs per spacy batch", type="int", default=32 )
+parser.add_option( "--processes", dest="processes", help="Number of spacy worker processes", type="int", default=1 )
+parser.add_option( "--queue-size", dest="queueSize", help="Maximum parsed paragraphs waiting to be written", type="int", default=64 )
+parser.add_option( "--concurrency", dest="concurrency", help="Keep up to N paragraph writes in flight on an async driver (0 = write synchronously)", type="int", default=CONCURRENCY )
 
 class Spacy2Neo4j(NeoBridge):
     
-    def __init__( self ):
-        super().__init__( name="spacy2neo4j", version="1.1.0" )
+    def __init__( self, export = None, concurrency = 0 ):
+        super().__init__( name="spacy2neo4j", version="1.1.0", export=export, concurrency=concurrency )
 
-        with self.driver.session() as session:
-            session.run( "CREATE INDEX tokenIndex IF NOT EXISTS FOR (t:Token) ON (t.index, t.paragraph)" )
-            session.run( "CREATE INDEX tagIndex IF NOT EXISTS FOR (t:Tag) ON (t.type)" )
+        self.schema( "CREATE INDEX tokenIndex IF NOT EXISTS FOR (t:Token) ON (t.index, t.paragraph)" )
+        self.schema( "CREATE INDEX tagIndex IF NOT EXISTS FOR (t:Tag) ON (t.type)" )
         
         self.addIndexedUUID( "Token" )
         self.addIndexedUUID( "Source" )
-        self.addIndexedUUID( "Entity" )
+        self.addIndexedUUID( "Paragraph" )
+
+        # Unique, so concurrent compact writes and hash/aggregate updates can't MERGE the same paragraph twice
+        self.schema( "DROP INDEX paragraphIndex IF EXISTS" )
+        self.schema( "CREATE CONSTRAINT paragraphKey IF NOT EXISTS FOR (p:Paragraph) REQUIRE (p.source, p.index) IS UNIQUE" )
+
+        # Entities are open-ended, so they're merged as they come up (through the index) rather than preloaded
+        self.schema( "CREATE INDEX entityIndex IF NOT EXISTS FOR (e:Entity) ON (e.text, e.type)" )
+        self.addDimension( "Entity", ["text", "type"], maxSize=ENTITY_CACHE )
+        self.addDimension( "Lemma", ["text", "language"] )
+        self.addDimension( "Tag", ["class", "type"] )
+        self.addDimension( "Cluster", ["id", "source"] )
 
     def update_source( self, title, url ):
-        with self.driver.session() as session:
-            session.run( "MERGE (n:Source {title: $t, url: $u})", t=title, u=url )
-            res = session.run( "MATCH (n:Source {title: $t, url: $u}) RETURN n.uuid", t=title, u=url )
-            return res.single()[0]
+        if self.export is not None:
+            srcUUID = stableUUID( "Source", title, url )
+            self.export.node( "Source", srcUUID, { "title": title, "url": url } )
+            return srcUUID
+
+        res = self.uow.query( "MERGE (n:Source {title: $t, url: $u}) SET n.uuid = coalesce(n.uuid, randomUUID()) RETURN n.uuid", t=title, u=url )
+        return res[0][0]
     
-    def update_entity( self, srcUUID, paraIndex, entity):
-        with self.driver.session() as session:
-            session.run( "MERGE (e:Entity {text: $text, type: $type})", text = entity.text, type = entity.label_ )
-            res = session.run( "MATCH (e:Entity {text: $text, type: $type}) RETURN e.uuid", text = entity.text, type = entity.label_ )
-            eUUID = res.single()[0]
-            session.close()
-
-        for tokID in range(entity.start, entity.end):
-            logger.debug( f"\t- Map {entity.label_} To {paraIndex}/{tokID} in {srcUUID}" )
-            with self.driver.session() as session:
-                session.run(
-                    "MATCH (e:Entity {uuid:$uuid}), (t:Token {source: $source, paragraph: $iPara, index: $iToken}) MERGE (t)-[:Is]->(e)",
-                    uuid = eUUID,
-                    source = srcUUID,
-                    iPara = paraIndex,
-                    iToken = tokID
+    def checkpoint_source( self, srcUUID, paraIndex ):
+        if self.export is not None:
+            return
+
+        self.uow.run( "MATCH (n:Source {uuid: $uuid}) SET n.lastParagraph = $iPara", uuid=srcUUID, iPara=paraIndex )
+
+    def source_checkpoints( self ):
+        # (title, url) -> last paragraph fully written, for every source we've started
+        if self.export is not None:
+            return {}
+
+        res = self.uow.fetch( "MATCH (n:Source) WHERE n.lastParagraph IS NOT NULL RETURN n.title, n.url, n.lastParagraph" )
+        return { (record[0], record[1]): record[2] for record in res }
+
+    def paragraph_hashes( self ):
+        # (title, url) -> {paragraph index: content hash}, for everything written so far
+        if self.export is not None:
+            return {}
+
+        res = self.uow.fetch( "MATCH (p:Paragraph)-[:PartOf]->(s:Source) WHERE p.hash IS NOT NULL RETURN s.title, s.url, p.index, p.hash" )
+        hashes = {}
+        for record in res:
+            hashes.setdefault( (record[0], record[1]), {} )[record[2]] = record[3]
+        return hashes
+
+    def hash_paragraph( self, srcUUID, paraIndex, paraHash ):
+        if self.export is not None:
+            return
+
+        self.uow.run(
+            "MATCH (s:Source {uuid: $source}) MERGE (p:Paragraph {source: $source, index: $iPara}) MERGE (p)-[:PartOf]->(s) SET p.hash = $hash, p.writtenAt = timestamp()",
+            source=srcUUID, iPara=paraIndex, hash=paraHash
+        )
+
+    def hash_source( self, srcUUID, srcHash ):
+        if self.export is not None:
+            return
+
+        self.uow.run( "MATCH (n:Source {uuid: $uuid}) SET n.contentHash = $hash", uuid=srcUUID, hash=srcHash )
+
+    def trim_source( self, srcUUID, count ):
+        # A source that's lost paragraphs drops everything from `count` on, taking back their aggregate counts
+        if self.export is not None:
+            return
+
+        self.uow.write( runStatements, self._trim_statements, (srcUUID, count) )
+
+    @staticmethod
+    def _trim_statements( srcUUID, count ):
+        res = yield (
+            "MATCH (p:Paragraph {source: $source}) WHERE p.index >= $count "
+            "RETURN [p.lemmas, p.lemmaCounts, p.tags, p.tagCounts, p.entities, p.entityCounts]",
+            { "source": srcUUID, "count": count }
+        )
+
+        removed = { "Lemma": Counter(), "Tag": Counter(), "Entity": Counter() }
+        pairs = Counter()
+        for record in res:
+            old = record[0]
+            for (label, keys, counts) in [ ("Lemma", old[0], old[1]), ("Tag", old[2], old[3]), ("Entity", old[4], old[5]) ]:
+                removed[label].update( dict( zip( keys or [], counts or [] ) ) )
+            pairs.update( combinations( sorted( old[4] or [] ), 2 ) )
+
+        for (label, rel) in [ ("Lemma", "Uses"), ("Tag", "Uses"), ("Entity", "MentionCount") ]:
+            delta = countDelta( {}, list(removed[label].keys()), list(removed[label].values()) )
+            if len(delta) > 0:
+                yield (
+                    f"MATCH (s:Source {{uuid: $source}}) UNWIND $delta AS row MATCH (s)-[r:{rel}]->(n:{label} {{uuid: row[0]}}) "
+                    "SET r.count = r.count + row[1]",
+                    { "source": srcUUID, "delta": delta }
                 )
-                session.close()
-
-
-    def update_token( self, srcUUID, paraIndex, token ):
-        with self.driver.session() as session:
-            session.run(
-                "MERGE (t:Token {text: $text, paragraph: $iPara, index: $iToken, norm: $norm, language: $lang, source: $uuid})",
-                uuid = srcUUID,
-                text = token.text,
-                iPara = paraIndex,
-                iToken = token.i,
-                norm = token.norm_,
-                lang = token.lang_
-            )
-            res = session.run(
-                "MATCH (n:Token {text: $text, paragraph: $iPara, index: $iToken, norm: $norm, language: $lang, source: $uuid}) RETURN n.uuid",
-                uuid = srcUUID,
-                text = token.text,
-                iPara = paraIndex,
-                iToken = token.i,
-                norm = token.norm_,
-                lang = token.lang_
-            )
-            tokUUID = res.single()[0]
-
-            session.run( "MERGE (l:Lemma {text: $lemma, language: $lang})", lemma=token.lemma_, lang = token.lang_ )
-            session.run(
-                "MATCH (tok:Token {uuid: $tok}), (prop:Lemma {text: $lemma, language: $lang}) MERGE (tok)-[:Is]->(prop)",
-                tok = tokUUID,
-                lemma = token.lemma_,
-                lang = token.lang_
+
+        if len(pairs) > 0:
+            yield (
+                "UNWIND $pairs AS row MATCH (a:Entity {uuid: row[0]})-[r:CoOccurs]->(b:Entity {uuid: row[1]}) SET r.count = r.count - row[2]",
+                { "pairs": [ [a, b, n] for ((a, b), n) in pairs.items() ] }
             )
-            
 
-            # Add a tag value for this token
-            session.run( "MERGE (tag:Tag {class: 'fine', type: $tokType})", tokType=token.tag_ )
-            session.run(
-                "MATCH (tok:Token {uuid: $tok}), (tag:Tag {class: 'fine', type: $tokType}) MERGE (tok)-[:Tagged]->(tag)",
-                tok = tokUUID,
-                tokType = token.tag_
+        yield ( "MATCH (t:Token {source: $source}) WHERE t.paragraph >= $count DETACH DELETE t", { "source": srcUUID, "count": count } )
+        yield ( "MATCH (p:Paragraph {source: $source}) WHERE p.index >= $count DETACH DELETE p", { "source": srcUUID, "count": count } )
+        yield (
+            "MATCH (s:Source {uuid: $source}) WHERE s.lastParagraph >= $count SET s.lastParagraph = $count - 1",
+            { "source": srcUUID, "count": count }
+        )
+
+    def clear_paragraph( self, srcUUID, paraIndex ):
+        # An edited paragraph's old tokens (and their links) go before it's written again
+        if self.export is not None:
+            return
+
+        self.uow.query( "MATCH (t:Token {source: $source, paragraph: $iPara}) DETACH DELETE t", source=srcUUID, iPara=paraIndex )
+
+    def update_entity( self, srcUUID, paraIndex, entity, exportTokens = True ):
+        eUUID = self.dimension( "Entity", text=entity.text, type=entity.label_ )
+
+        if self.export is not None:
+            # Without the Token nodes in the export, the links would leave neo4j-admin dangling relationships
+            if not exportTokens:
+                return
+            for tokID in range(entity.start, entity.end):
+                self.export.relationship( "Is", stableUUID( "Token", srcUUID, paraIndex, tokID ), eUUID )
+            return
+
+        logger.debug( f"\t- Map {entity.label_} To {paraIndex}/{entity.start}-{entity.end} in {srcUUID}" )
+
+        # The span's tokens may still be in flight when writing asynchronously
+        self.afterWrites( self._link_entity, eUUID, srcUUID, paraIndex, list(range(entity.start, entity.end)) )
+
+    def _link_entity( self, eUUID, srcUUID, paraIndex, iTokens ):
+        self.uow.run(
+            "MATCH (e:Entity {uuid:$uuid}) UNWIND $iTokens AS iToken MATCH (t:Token {source: $source, paragraph: $iPara, index: iToken}) MERGE (t)-[:Is]->(e)",
+            uuid = eUUID,
+            source = srcUUID,
+            iPara = paraIndex,
+            iTokens = iTokens
+        )
+
+
+    def update_aggregates( self, srcUUID, paraIndex, doc ):
+        # Counts we'd otherwise have to walk every Token for, kept on a Paragraph node (as parallel
+        # arrays) and summed onto Source -> Lemma/Tag/Entity and Entity -> Entity relationships
+        if self.export is not None:
+            return
+
+        lang = doc.lang_
+        hasPymusas = hasPymusasTags()
+        lemmas = Counter( self.resolveDimensions( "Lemma", [ { "text": tok.lemma_, "language": lang } for tok in doc ] ) )
+        tags = Counter( self.resolveDimensions( "Tag",
+            [ { "class": "fine", "type": tok.tag_ } for tok in doc ]
+            + [ { "class": "coarse", "type": tok.pos_ } for tok in doc ]
+            + [ { "class": "pymusas", "type": pTag } for tok in doc if hasPymusas for pTag in (tok._.pymusas_tags or []) ]
+        ) )
+        entities = Counter( self.resolveDimensions( "Entity", [ { "text": ent.text, "type": ent.label_ } for ent in doc.ents ] ) )
+
+        # Counters are plain data, so this is safe to replay; it stays in the synchronous lane so
+        # concurrent paragraphs never race to increment the same count
+        self.uow.write( runStatements, self._aggregate_statements, (srcUUID, paraIndex, lemmas, tags, entities) )
+
+    @staticmethod
+    def _aggregate_statements( srcUUID, paraIndex, lemmas, tags, entities ):
+        # Swap in this paragraph's counts, getting back whatever it had before (if it's been written already)
+        res = yield (
+            "MERGE (p:Paragraph {source: $source, index: $iPara}) "
+            "WITH p, [p.lemmas, p.lemmaCounts, p.tags, p.tagCounts, p.entities, p.entityCounts] AS old "
+            "SET p.lemmas = $lemmas, p.lemmaCounts = $lemmaCounts, p.tags = $tags, p.tagCounts = $tagCounts, "
+            "p.entities = $entities, p.entityCounts = $entityCounts "
+            "WITH p, old MATCH (s:Source {uuid: $source}) MERGE (p)-[:PartOf]->(s) "
+            "RETURN old",
+            {
+                "source": srcUUID,
+                "iPara": paraIndex,
+                "lemmas": list(lemmas.keys()),
+                "lemmaCounts": list(lemmas.values()),
+                "tags": list(tags.keys()),
+                "tagCounts": list(tags.values()),
+                "entities": list(entities.keys()),
+                "entityCounts": list(entities.values())
+            }
+        )
+        old = res[0][0] if len(res) > 0 else [None] * 6
+
+        # So the source totals only move by the difference
+        for (label, rel, counts, oldKeys, oldCounts) in [
+            ( "Lemma", "Uses", lemmas, old[0], old[1] ),
+            ( "Tag", "Uses", tags, old[2], old[3] ),
+            ( "Entity", "MentionCount", entities, old[4], old[5] )
+        ]:
+            delta = countDelta( counts, oldKeys, oldCounts )
+            if len(delta) > 0:
+                yield (
+                    f"MATCH (s:Source {{uuid: $source}}) UNWIND $delta AS row MATCH (n:{label} {{uuid: row[0]}}) "
+                    f"MERGE (s)-[r:{rel}]->(n) SET r.count = coalesce(r.count, 0) + row[1]",
+                    { "source": srcUUID, "delta": delta }
+                )
+
+        # Co-occurrence counts the paragraphs both entities appear in, stored once per pair (lower UUID first)
+        before = set( combinations( sorted( old[4] or [] ), 2 ) )
+        after = set( combinations( sorted( entities.keys() ), 2 ) )
+        pairs = [ [a, b, 1] for (a, b) in after - before ] + [ [a, b, -1] for (a, b) in before - after ]
+        if len(pairs) > 0:
+            yield (
+                "UNWIND $pairs AS row MATCH (a:Entity {uuid: row[0]}), (b:Entity {uuid: row[1]}) "
+                "MERGE (a)-[r:CoOccurs]->(b) SET r.count = coalesce(r.count, 0) + row[2]",
+                { "pairs": pairs }
             )
 
-            session.run( "MERGE (tag:Tag {class: 'coarse', type: $posType})", posType=token.pos_ )
-            session.run(
-                "MATCH (tok:Token {uuid: $tok}), (tag:Tag {class: 'coarse', type: $posType}) MERGE (tok)-[:Tagged]->(tag)",
-                tok = tokUUID,
-                posType = token.pos_
+    def update_tokens( self, srcUUID, paraIndex, doc ):
+        # Returns the token UUIDs, or a Future for them when writing asynchronously
+        (lang, columns) = self.token_columns( srcUUID, doc )
+        if len(columns["text"]) == 0:
+            return []
+
+        if self.export is not None:
+            return self._export_tokens( srcUUID, paraIndex, lang, columns )
+
+        return self.write( self._token_statements, srcUUID, paraIndex, lang, columns )
+
+    def token_columns( self, srcUUID, doc ):
+        # Columnar view of the paragraph, one list entry per token
+        hasPymusas = hasPymusasTags()
+        columns = {
+            "text": [],
+            "norm": [],
+            "index": [],
+            "lemma": [],
+            "tag": [],
+            "pos": [],
+            "cluster": [],
+            "pymusas": []
+        }
+        for tok in doc:
+            columns["text"].append( tok.text )
+            columns["norm"].append( tok.norm_ )
+            columns["index"].append( tok.i )
+            columns["lemma"].append( tok.lemma_ )
+            columns["tag"].append( tok.tag_ )
+            columns["pos"].append( tok.pos_ )
+            columns["cluster"].append( tok.cluster )
+            columns["pymusas"].append( list(tok._.pymusas_tags or []) if hasPymusas else [] )
+
+        # Resolve lemma, tag and cluster nodes up front, so the write only has to link to them
+        lang = doc.lang_
+        columns["lemma"] = self.resolveDimensions( "Lemma", [ { "text": lemma, "language": lang } for lemma in columns["lemma"] ] )
+        columns["tag"] = self.resolveDimensions( "Tag", [ { "class": "fine", "type": tag } for tag in columns["tag"] ] )
+        columns["pos"] = self.resolveDimensions( "Tag", [ { "class": "coarse", "type": pos } for pos in columns["pos"] ] )
+        columns["pymusas"] = [
+            self.resolveDimensions( "Tag", [ { "class": "pymusas", "type": pTag } for pTag in tags ] ) for tags in columns["pymusas"]
+        ]
+
+        clusters = [ (i, cluster) for (i, cluster) in enumerate(columns["cluster"]) if cluster != 0 ]
+        clusterUUIDs = self.resolveDimensions( "Cluster", [ { "id": cluster, "source": srcUUID } for (i, cluster) in clusters ] )
+        columns["cluster"] = [None] * len(columns["cluster"])
+        for ((i, cluster), clusterUUID) in zip( clusters, clusterUUIDs ):
+            columns["cluster"][i] = clusterUUID
+
+        return (lang, columns)
+
+    def update_paragraph( self, srcUUID, paraIndex, doc, withTokens = True, withEntities = True ):
+        # Compact schema: the paragraph's tokens as parallel arrays on its Paragraph node, pointing at
+        # lemma/tag UUIDs, and entities as Contains relationships holding the span's token range.
+        # Token nodes can still be made for any paragraph later, with materialise_tokens()
+        props = { "language": doc.lang_ }
+        if withTokens:
+            (lang, columns) = self.token_columns( srcUUID, doc )
+            props.update( {
+                "tokenTexts": columns["text"],
+                "tokenNorms": columns["norm"],
+                "tokenOffsets": [ tok.idx for tok in doc ],
+                "tokenLemmas": columns["lemma"],
+                "tokenTags": columns["tag"],
+                "tokenPos": columns["pos"],
+                "tokenClusters": [ cluster or "" for cluster in columns["cluster"] ],
+                "pymusasTokens": [ i for (i, tags) in enumerate( columns["pymusas"] ) for tag in tags ],
+                "pymusasTags": [ tag for tags in columns["pymusas"] for tag in tags ]
+            } )
+
+        spans = None
+        if withEntities:
+            eUUIDs = self.resolveDimensions( "Entity", [ { "text": ent.text, "type": ent.label_ } for ent in doc.ents ] )
+            spans = [ { "entity": eUUID, "start": ent.start, "end": ent.end } for (ent, eUUID) in zip( doc.ents, eUUIDs ) ]
+
+        if self.export is not None:
+            return self._export_paragraph( srcUUID, paraIndex, props, spans )
+
+        return self.write( self._paragraph_statements, srcUUID, paraIndex, props, spans )
+
+    def _export_paragraph( self, srcUUID, paraIndex, props, spans ):
+        paraUUID = stableUUID( "Paragraph", srcUUID, paraIndex )
+        self.export.node( "Paragraph", paraUUID, dict( props, source=srcUUID, index=paraIndex ), dedupe=False, types=PARAGRAPH_TYPES )
+        self.export.relationship( "PartOf", paraUUID, srcUUID )
+        for span in spans or []:
+            self.export.relationship( "Contains", paraUUID, span["entity"], { "start": span["start"], "end": span["end"] } )
+        return paraUUID
+
+    @staticmethod
+    def _paragraph_statements( srcUUID, paraIndex, props, spans ):
+        res = yield (
+            "MATCH (s:Source {uuid: $source}) "
+            "MERGE (p:Paragraph {source: $source, index: $iPara}) "
+            "MERGE (p)-[:PartOf]->(s) "
+            "SET p += $props, p.writtenAt = timestamp() "
+            "RETURN p.uuid",
+            { "source": srcUUID, "iPara": paraIndex, "props": props }
+        )
+
+        # Spans are replaced wholesale, so re-written paragraphs don't keep stale ones
+        if spans is not None:
+            yield (
+                "MATCH (p:Paragraph {source: $source, index: $iPara})-[c:Contains]->(:Entity) DELETE c",
+                { "source": srcUUID, "iPara": paraIndex }
+            )
+            yield (
+                "MATCH (p:Paragraph {source: $source, index: $iPara}) UNWIND $spans AS span "
+                "MATCH (e:Entity {uuid: span.entity}) CREATE (p)-[:Contains {start: span.start, end: span.end}]->(e)",
+                { "source": srcUUID, "iPara": paraIndex, "spans": spans }
             )
 
-            # Dependencies have spans, this needs to be a group merge!
-            #session.run( "MERGE (dep:Dependency {type: $depType})", depType=token.dep_ )
-            #session.run(
-            #    "MATCH (tok:Token {paragraph: $iPara, index: $iToken, source: $uuid}), (dep:Dependency {type: $depType}) MERGE (tok)<-[:DependsOn]-(dep)",
-            #    uuid = srcUUID,
-            #    iPara = paraIndex,
-            #    iToken = token.i,
-            #    depType = token.dep_
-            #)
-
-            if token.cluster != 0:
-                session.run( "MERGE (grp:Cluster {id: $id, source: $uuid})", id=token.cluster, uuid = srcUUID )
-                session.run(
-                    "MATCH (tok:Token {uuid: $tok}), (grp:Cluster {id: $id, source: $uuid}) MERGE (tok)-[:PartOf]->(grp)",
-                    tok = tokUUID,
-                    uuid = srcUUID,
-                    id = token.cluster
-                )
+        return res[0][0] if len(res) > 0 else None
+
+    def materialise_tokens( self, srcUUID, paraIndex ):
+        # Turn a compact paragraph into Token nodes (with their Is, Tagged, PartOf and Next links and
+        # entity Is links) exactly as the full schema would have written them; returns their UUIDs
+        if self.export is not None:
+            raise ValueError( "Tokens can only be materialised from a database, not when exporting" )
+
+        res = self.uow.fetch(
+            "MATCH (p:Paragraph {source: $source, index: $iPara}) WHERE p.tokenTexts IS NOT NULL "
+            "RETURN p.language, p.tokenTexts, p.tokenNorms, p.tokenLemmas, p.tokenTags, p.tokenPos, p.tokenClusters, "
+            "p.pymusasTokens, p.pymusasTags, [(p)-[c:Contains]->(e:Entity) | [e.uuid, c.start, c.end]]",
+            source=srcUUID, iPara=paraIndex
+        )
+        if len(res) == 0 or len(res[0][1]) == 0:
+            return []
+
+        (lang, texts, norms, lemmas, tags, pos, clusters, pymusasTokens, pymusasTags, spans) = res[0]
+        pymusas = [ [] for text in texts ]
+        for (i, tag) in zip( pymusasTokens, pymusasTags ):
+            pymusas[i].append( tag )
+
+        columns = {
+            "text": texts,
+            "norm": norms,
+            "index": list( range( len(texts) ) ),
+            "lemma": lemmas,
+            "tag": tags,
+            "pos": pos,
+            "cluster": [ cluster or None for cluster in clusters ],
+            "pymusas": pymusas
+        }
+        tokUUIDs = self.uow.write( runStatements, self._token_statements, (srcUUID, paraIndex, lang, columns) )
+
+        for (eUUID, start, end) in spans:
+            self._link_entity( eUUID, srcUUID, paraIndex, list( range( start, end ) ) )
+        self.uow.commit()
+
+        return tokUUIDs
+
+    def _export_tokens( self, srcUUID, paraIndex, lang, columns ):
+        tokUUIDs = []
+        for i in range(len(columns["text"])):
+            tokUUID = stableUUID( "Token", srcUUID, paraIndex, columns["index"][i] )
+            tokUUIDs.append( tokUUID )
+
+            # Tokens are unique per (source, paragraph, index), so there's no need to remember them
+            self.export.node( "Token", tokUUID, {
+                "text": columns["text"][i],
+                "paragraph": paraIndex,
+                "index": columns["index"][i],
+                "norm": columns["norm"][i],
+                "language": lang,
+                "source": srcUUID
+            }, dedupe=False )
+
+            self.export.relationship( "Is", tokUUID, columns["lemma"][i] )
+            self.export.relationship( "Tagged", tokUUID, columns["tag"][i] )
+            self.export.relationship( "Tagged", tokUUID, columns["pos"][i] )
+            if columns["cluster"][i] is not None:
+                self.export.relationship( "PartOf", tokUUID, columns["cluster"][i] )
+            for tagUUID in columns["pymusas"][i]:
+                self.export.relationship( "Tagged", tokUUID, tagUUID )
+            if i > 0:
+                self.export.relationship( "Next", tokUUIDs[i - 1], tokUUID )
+
+        return tokUUIDs
+
+    @staticmethod
+    def _token_statements( srcUUID, paraIndex, lang, columns ):
+        # Tokens first, so we get every UUID back in one result set
+        res = yield (
+            "UNWIND range(0, size($text) - 1) AS i "
+            "MERGE (t:Token {text: $text[i], paragraph: $iPara, index: $index[i], norm: $norm[i], language: $lang, source: $uuid}) "
+            "ON CREATE SET t.uuid = randomUUID() "
+            "RETURN i, t.uuid",
+            {
+                "uuid": srcUUID,
+                "iPara": paraIndex,
+                "lang": lang,
+                "text": columns["text"],
+                "index": columns["index"],
+                "norm": columns["norm"]
+            }
+        )
+        tokUUIDs = [None] * len(columns["text"])
+        for record in res:
+            tokUUIDs[record[0]] = record[1]
+
+        # Lemmas, fine and coarse tags
+        yield (
+            "UNWIND range(0, size($tok) - 1) AS i "
+            "MATCH (tok:Token {uuid: $tok[i]}), (l:Lemma {uuid: $lemma[i]}), (fine:Tag {uuid: $tag[i]}), (coarse:Tag {uuid: $pos[i]}) "
+            "MERGE (tok)-[:Is]->(l) "
+            "MERGE (tok)-[:Tagged]->(fine) "
+            "MERGE (tok)-[:Tagged]->(coarse)",
+            { "tok": tokUUIDs, "lemma": columns["lemma"], "tag": columns["tag"], "pos": columns["pos"] }
+        )
+
+        clusters = [ [tokUUIDs[i], cluster] for (i, cluster) in enumerate(columns["cluster"]) if cluster is not None ]
+        if len(clusters) > 0:
+            yield (
+                "UNWIND $pairs AS pair "
+                "MATCH (tok:Token {uuid: pair[0]}), (grp:Cluster {uuid: pair[1]}) "
+                "MERGE (tok)-[:PartOf]->(grp)",
+                { "pairs": clusters }
+            )
 
-            # Link to the previous node in the series, if present
-            session.run(
-                "MATCH (t:Token {uuid: $tok}), (p:Token {paragraph: $iPara, index: $pToken, source: $uuid}) MERGE (p)-[:Next]->(t)",
-                uuid = srcUUID,
-                tok = tokUUID,
-                iPara = paraIndex,
-                pToken = token.i - 1
+        # Link each token to the previous one in the series
+        yield (
+            "UNWIND range(1, size($tok) - 1) AS i "
+            "MATCH (p:Token {uuid: $tok[i - 1]}), (t:Token {uuid: $tok[i]}) "
+            "MERGE (p)-[:Next]->(t)",
+            { "tok": tokUUIDs }
+        )
+
+        ### PyMUSAS extra tags ###
+        pymusas = [ [tokUUIDs[i], pTag] for (i, tags) in enumerate(columns["pymusas"]) for pTag in tags ]
+        if len(pymusas) > 0:
+            yield (
+                "UNWIND $pairs AS pair "
+                "MATCH (tok:Token {uuid: pair[0]}), (tag:Tag {uuid: pair[1]}) "
+                "MERGE (tok)-[:Tagged]->(tag)",
+                { "pairs": pymusas }
             )
 
-            ### PyMUSAS extra tags ###
-            if token._.pymusas_tags:
-                for pTag in token._.pymusas_tags:
-                    sys.stdout.write( f"[{pTag}] " )
-                    session.run( "MERGE (tag:Tag {class: 'pymusas', type: $tagType})", tagType=pTag )
-                    session.run(
-                        "MATCH (tok:Token {uuid: $tok}), (tag:Tag {class: 'pymusas', type: $tagType}) MERGE (tok)-[:Tagged]->(tag)",
-                        tok = tokUUID,
-                        tagType = pTag
-                    )
-
-            ### ================== ###
-
-            # If we have an entity type, add in a link for this too
-            #if token.ent_type_ != "" and (token.ent_iob == 3 or token.ent_iob == 1):
-            #    session.run( "MERGE (ent:Entity {type: $entType})", entType=token.ent_type_ )
-            #    session.run(
-            #        "MATCH (tok:Token {paragraph: $iPara, index: $iToken, source: $uuid}), (ent:Entity {type: $entType}) MERGE (tok)<-[:Is]-(ent)",
-            #        uuid = srcUUID,
-            #        iPara = paraIndex,
-            #        iToken = token.i,
-            #        entType = token.ent_type_
-            #    )
-
-            return tokUUID
+        return tokUUIDs
     
     
 
@@ -174,83 +523,495 @@ class Spacy2Neo4j(NeoBridge):
     #                    "RETURN a.message + ', from node ' + id(a)", message=message)
     #    return result.single()[0]
 
-if __name__ == "__main__":
-    (options, args) = parser.parse_args()
+def readXML( path ):
+    # Stream <source> elements one <para> at a time, clearing anything we've finished with
+    stack = []
+    root = None
+    source = None
+
+    for (event, elem) in ET.iterparse( path, events=("start", "end") ):
+        if event == "start":
+            if root is None:
+                root = elem
+            stack.append( elem.tag )
+
+            if stack == [root.tag, 'source']:
+                source = { "title": None, "url": None, "paraIndex": -1, "pending": [] }
+            continue
+
+        stack.pop()
+        if source is None or len(stack) != 2:
+            if stack == [root.tag] and elem.tag == 'source':
+                # Flush anything we were holding for a source with no title/url
+                yield from flushSource( path, source )
+                source = None
+                root.clear()
+            continue
+
+        # Direct children of a <source>
+        if elem.tag == 'title' and source["title"] is None:
+            source["title"] = elem.text or ""
+        elif elem.tag == 'url' and source["url"] is None:
+            source["url"] = elem.text or ""
+        elif elem.tag == 'para':
+            source["paraIndex"] = source["paraIndex"] + 1
+            source["pending"].append( (source["paraIndex"], (elem.text or "").replace("[","").replace("]","")) )
+            elem.clear()
+
+        if source["title"] is not None and source["url"] is not None:
+            yield from flushSource( path, source )
+
+
+def flushSource( path, source ):
+    if not source.get( "logged" ):
+        source["logged"] = True
+        logger.info( f"Processing XML {path} - {source['title']}: {source['url']}" )
+
+    for (paraIndex, text) in source["pending"]:
+        yield ( source["title"], source["url"], paraIndex, text )
+    source["pending"] = []
+
+
+def readTXT( path, maxChunk ):
+    # Blank lines separate paragraphs; anything longer than maxChunk is split at a line (or word) boundary
+    title = os.path.basename( path )
+    logger.info( f"Processing TXT {path} - {title}" )
+
+    paraIndex = -1
+    for text in chunkLines( open( path, mode='r' ), maxChunk ):
+        paraIndex = paraIndex + 1
+        yield ( title, path, paraIndex, text )
+
+
+def chunkLines( lines, maxChunk ):
+    with lines:
+        chunk = ""
+        for line in lines:
+            if line.strip() == "":
+                if chunk.strip() != "":
+                    yield chunk.strip()
+                chunk = ""
+                continue
+
+            if len(chunk) + len(line) > maxChunk and chunk.strip() != "":
+                yield chunk.strip()
+                chunk = ""
+
+            while len(line) > maxChunk:
+                cut = line.rfind( " ", 0, maxChunk )
+                if cut <= 0:
+                    cut = maxChunk
+                yield line[:cut].strip()
+                line = line[cut:]
+
+            chunk = chunk + line
+
+        if chunk.strip() != "":
+            yield chunk.strip()
+
+
+class ParagraphWriter(threading.Thread):
+
+    def __init__( self, db, doTokens, doEntities, doAggregates, compact, queueSize, trim = False ):
+        super().__init__( name="ParagraphWriter", daemon=True )
+        self.db = db
+        self.trim = trim
+        self.doTokens = doTokens
+        self.doEntities = doEntities
+        self.doAggregates = doAggregates
+        self.compact = compact
+        self.queue = queue.Queue( maxsize=queueSize )
+        self.sources = {}
+        self.current = None
+        self.error = None
+
+        # Stored paragraph hashes, and how many paragraphs each source has in this run's input. The
+        # parsing side reads and fills these while we write, so both are only touched under the lock
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.counts = {}
+        self.hashed = set()
+
+    def run( self ):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.finish_sources()
+                return
+
+            # Keep draining after a failure, so the parser side never blocks on a full queue
+            if self.error is not None:
+                continue
+
+            try:
+                self.write( *item )
+            except Exception as e:
+                logger.exception( "Writer failed" )
+                self.error = e
+
+    def write( self, title, url, paraIndex, parsed, paraHash, previous ):
+        if (title, url) not in self.sources:
+            self.sources[(title, url)] = self.db.update_source( title, url )
+        srcUUID = self.sources[(title, url)]
+
+        if self.current != (title, url):
+            if self.current is not None:
+                self.hash_source( self.current )
+            self.current = (title, url)
+
+        if self.compact:
+            if self.doTokens or self.doEntities:
+                self.db.update_paragraph( srcUUID, paraIndex, parsed, self.doTokens, self.doEntities )
+                logger.info( f"Wrote paragraph {paraIndex} ({len(parsed)} tokens, {len(parsed.ents)} entities)" )
+
+        elif previous is not None and self.doTokens:
+            self.db.clear_paragraph( srcUUID, paraIndex )
+
+        if self.doTokens and not self.compact:
+            tokUUIDs = self.db.update_tokens( srcUUID, paraIndex, parsed )
+            if isinstance( tokUUIDs, list ):
+                logger.info( f"Wrote {len(tokUUIDs)} tokens for paragraph {paraIndex}" )
+            else:
+                logger.info( f"Queued {len(parsed)} tokens for paragraph {paraIndex}" )
+
+        if self.doEntities and not self.compact:
+            for ent in parsed.ents:
+                self.db.update_entity( srcUUID, paraIndex, ent, exportTokens=self.doTokens )
+
+        if self.doAggregates:
+            self.db.update_aggregates( srcUUID, paraIndex, parsed )
+
+        # Only once this paragraph, and everything before it, has committed
+        self.db.afterWrites( self.db.checkpoint_source, srcUUID, paraIndex )
+        self.db.afterWrites( self.db.hash_paragraph, srcUUID, paraIndex, paraHash )
+        with self.lock:
+            self.hashes.setdefault( (title, url), {} )[paraIndex] = paraHash
+
+    def saw_paragraph( self, title, url, paraIndex ):
+        with self.lock:
+            self.counts[(title, url)] = max( self.counts.get( (title, url), 0 ), paraIndex + 1 )
+
+    def stored_hash( self, title, url, paraIndex ):
+        with self.lock:
+            return self.hashes.get( (title, url), {} ).get( paraIndex )
+
+    def hash_source( self, source ):
+        # The source's hash covers its paragraph hashes in order, stored and new. When trimming, that's
+        # up to where the input now ends, and anything stored past that end is removed
+        with self.lock:
+            count = self.counts.get( source )
+            hashes = self.hashes.setdefault( source, {} )
+            stale = [ i for i in hashes.keys() if self.trim and count is not None and i >= count ]
+            for i in stale:
+                del hashes[i]
+            srcHash = contentHash( *[ hashes[i] for i in sorted( hashes.keys() ) ] )
+
+        if source not in self.sources:
+            self.sources[source] = self.db.update_source( *source )
+        if len(stale) > 0:
+            logger.info( f"Removing {len(stale)} paragraphs past the end of {source[0]}" )
+            self.db.afterWrites( self.db.trim_source, self.sources[source], count )
+        self.db.afterWrites( self.db.hash_source, self.sources[source], srcHash )
+        self.hashed.add( source )
+
+    def finish_sources( self ):
+        # Sources we never wrote a paragraph of still need trimming if they've got shorter
+        if self.error is not None:
+            return
+
+        try:
+            if self.current is not None:
+                self.hash_source( self.current )
+
+            with self.lock:
+                shortened = [ source for (source, count) in self.counts.items()
+                    if self.trim and source not in self.hashed and any( i >= count for i in self.hashes.get( source, {} ) ) ]
+            for source in shortened:
+                self.hash_source( source )
+        except Exception as e:
+            logger.exception( "Writer failed" )
+            self.error = e
+
+    def put( self, item ):
+        if self.error is not None:
+            raise self.error
+        self.queue.put( item )
+
+    def finish( self ):
+        if self.is_alive():
+            self.queue.put( None )
+            self.join()
+        else:
+            # Nothing needed parsing, so the thread never started; there may still be sources to trim
+            self.finish_sources()
+        if self.error is not None:
+            raise self.error
+
+
+def countDelta( counts, oldKeys, oldCounts ):
+    # [key, change] for every count that differs from the old parallel arrays
+    delta = Counter( counts )
+    delta.subtract( dict( zip( oldKeys or [], oldCounts or [] ) ) )
+    return [ [key, change] for (key, change) in delta.items() if change != 0 ]
+
+
+def contentHash( *parts ):
+    return hashlib.blake2b( "\x1f".join( str(part) for part in parts ).encode( "utf-8" ), digest_size=16 ).hexdigest()
+
+
+def pipelineHash( options, version ):
+    # Anything that changes what we'd write for the same text
+    return contentHash(
+        options.spacy_data,
+        options.pymusas_data if options.doPymusas else "",
+        version,
+        options.doTokens,
+        options.doEntities,
+        options.doAggregates,
+        *( ["compact"] if options.compact else [] )
+    )
+
+
+def skipUnchanged( paragraphs, storedHash ):
+    # Drop paragraphs whose hash matches the stored one, passing on the old hash of edited ones
+    skipped = 0
+    for (title, url, paraIndex, text, paraHash) in paragraphs:
+        previous = storedHash( title, url, paraIndex )
+        if previous == paraHash:
+            skipped = skipped + 1
+            continue
+        yield (title, url, paraIndex, text, paraHash, previous)
+
+    logger.info( f"Skipped {skipped} unchanged paragraphs" )
+
+
+def countParagraphs( paragraphs, writer ):
+    # Every paragraph in the input, skipped or not, so the writer knows where each source now ends
+    for (title, url, paraIndex, text) in paragraphs:
+        writer.saw_paragraph( title, url, paraIndex )
+        yield (title, url, paraIndex, text)
+
+
+def skipWritten( paragraphs, checkpoints ):
+    skipped = 0
+    for (title, url, paraIndex, text) in paragraphs:
+        if paraIndex <= checkpoints.get( (title, url), -1 ):
+            skipped = skipped + 1
+            continue
+
+        if skipped > 0:
+            logger.info( f"Resuming {title} at paragraph {paraIndex} (skipped {skipped})" )
+            skipped = 0
+        yield (title, url, paraIndex, text)
+
+
+def cachedPipe( nlp, texts, cache, model, chunkSize = PARSE_CHUNK, **kwargs ):
+    # nlp.pipe, except texts already in the cache skip spacy; everything still comes out in input order.
+    # In one process, hits go straight out until there's a miss, then we hold on (to keys, not parses)
+    # until chunkSize texts are waiting and parse that chunk's misses in one go
+    pending = []
+
+    def fromCache( key, text, context ):
+        doc = cache.get( key )
+        if doc is None:
+            # Evicted since we looked
+            doc = nlp( text )
+            cache.put( key, doc )
+        return (doc, context)
+
+    if kwargs.get( "n_process", 1 ) > 1:
+        # A worker pool has to be forked before the writer thread starts, and only once, so with
+        # several processes everything goes through one nlp.pipe: hits as empty placeholder texts,
+        # swapped for their cached parse on the way out (spacy keeps the contexts in this process)
+        def placeholders():
+            for (text, context) in texts:
+                key = contentHash( model, text )
+                hit = key in cache
+                yield ("" if hit else text, (key, text, context, hit))
+
+        for (doc, (key, text, context, hit)) in nlp.pipe( placeholders(), as_tuples=True, **kwargs ):
+            if hit:
+                yield fromCache( key, text, context )
+            else:
+                cache.put( key, doc )
+                yield (doc, context)
+        return
+
+    def flush():
+        parsed = nlp.pipe( ( (text, context) for (key, text, context, hit) in pending if not hit ), as_tuples=True, **kwargs )
+        for (key, text, context, hit) in pending:
+            if hit:
+                yield fromCache( key, text, context )
+            else:
+                (doc, context) = next( parsed )
+                cache.put( key, doc )
+                yield (doc, context)
+        pending.clear()
+
+    for (text, context) in texts:
+        key = contentHash( model, text )
+        hit = key in cache
+        if hit and len(pending) == 0:
+            yield fromCache( key, text, context )
+            continue
+
+        pending.append( (key, text, context, hit) )
+        if len(pending) >= chunkSize:
+            yield from flush()
+
+    if len(pending) > 0:
+        yield from flush()
+
+
+def runPipeline( db, nlp, paragraphs, options, cache = None ):
+    # Paragraphs past a source's new end are only deleted when asked to skip unchanged ones, since a
+    # plain re-run may well be of an excerpt
+    writer = ParagraphWriter( db, options.doTokens, options.doEntities, options.doAggregates, options.compact, options.queueSize,
+        trim=options.skipUnchanged )
+
+    # Source hashes cover the stored paragraphs too, so they're loaded whether or not we skip any
+    writer.hashes = db.paragraph_hashes()
+    paragraphs = countParagraphs( paragraphs, writer )
+
+    if options.resume:
+        paragraphs = skipWritten( paragraphs, db.source_checkpoints() )
+
+    fingerprint = pipelineHash( options, db.version )
+    paragraphs = ( (title, url, paraIndex, text, contentHash( fingerprint, text )) for (title, url, paraIndex, text) in paragraphs )
+    if options.skipUnchanged:
+        paragraphs = skipUnchanged( paragraphs, writer.stored_hash )
+    else:
+        paragraphs = ( item + (None,) for item in paragraphs )
+
+    texts = ( (text, (title, url, paraIndex, paraHash, previous)) for (title, url, paraIndex, text, paraHash, previous) in paragraphs )
+    if cache is None:
+        docs = nlp.pipe( texts, as_tuples=True, batch_size=options.batchSize, n_process=options.processes )
+    else:
+        model = contentHash(
+            options.spacy_data,
+            modelVersion( options.spacy_data ),
+            options.pymusas_data if options.doPymusas else "",
+            modelVersion( options.pymusas_data ) if options.doPymusas else "",
+            excludedComponents( options )
+        )
+        docs = cachedPipe( nlp, texts, cache, model, batch_size=options.batchSize, n_process=options.processes )
+
+    for (parsed, (title, url, paraIndex, paraHash, previous)) in docs:
+        # Only start writing once spacy has forked any worker processes
+        if not writer.is_alive():
+            writer.start()
+
+        logger.info( f"Parsed paragraph: {paraIndex}" )
+        writer.put( (title, url, paraIndex, parsed, paraHash, previous) )
+
+    writer.finish()
+
+
+def registerPymusasTags():
+    # Parses read back from the cache carry their PyMUSAS tags in user_data, but without the model
+    # loaded nothing has registered the extension that reads them
+    from spacy.tokens import Token
+    if not Token.has_extension( "pymusas_tags" ):
+        Token.set_extension( "pymusas_tags", default=None )
+
+
+def hasPymusasTags():
+    # spacy is already loaded by the time there's a Doc to ask about
+    from spacy.tokens import Token
+    return Token.has_extension( "pymusas_tags" )
+
+
+def modelVersion( name ):
+    # Installed model packages know their version without being loaded; paths don't
+    try:
+        return importlib.metadata.version( name )
+    except (importlib.metadata.PackageNotFoundError, ValueError):
+        return ""
+
+
+def excludedComponents( options ):
+    exclude = list( UNUSED_COMPONENTS )
+    if not (options.doTokens or options.doAggregates or options.doPymusas):
+        exclude = exclude + TAGGING_COMPONENTS
+    if not (options.doEntities or options.doAggregates):
+        exclude = exclude + ENTITY_COMPONENTS
+    return exclude
+
+
+def loadPipeline( options ):
+    # Load the model once, leaving out whatever nothing we've been asked to write would read
+    start = time.perf_counter()
+    import spacy
+    imported = time.perf_counter()
 
     if spacy.prefer_gpu():
         logger.warning( "Using GPU compute!" )
 
-    # Default 'bare' Spacy 
-    nlp = spacy.load( options.spacy_data )
+    nlp = spacy.load( options.spacy_data, exclude=excludedComponents( options ) )
+    loaded = time.perf_counter()
 
     if options.doPymusas:
         logger.info( f"Using PyMUSAS with model: {options.pymusas_data}" )
-        nlp = spacy.load( options.spacy_data, exclude=['parser', 'ner'] )
 
-        # Load the English PyMUSAS rule-based tagger in a separate spaCy pipeline
-        english_tagger_pipeline = spacy.load( options.pymusas_data )
+        # Adds the English PyMUSAS rule-based tagger, from its own pipeline, to the main spaCy pipeline
+        nlp.add_pipe( 'pymusas_rule_based_tagger', source=spacy.load( options.pymusas_data ) )
 
-        # Adds the English PyMUSAS rule-based tagger to the main spaCy pipeline
-        nlp.add_pipe( 'pymusas_rule_based_tagger', source=english_tagger_pipeline )
-    
+    logger.info(
+        f"Loaded {options.spacy_data} ({', '.join( nlp.pipe_names )}) in {time.perf_counter() - start:.2f}s: "
+        f"import {imported - start:.2f}s, model {loaded - imported:.2f}s, pymusas {time.perf_counter() - loaded:.2f}s"
+    )
+    return nlp
 
-    db = Spacy2Neo4j()
 
-    if options.inputXML != None:
-        with open( options.inputXML, mode='r' ) as sourceXML:
-            xml = ET.fromstring( sourceXML.read() )
-
-            for source in xml.findall( 'source' ):
-                title = source.findtext( 'title' )
-                url = source.findtext( 'url' )
-
-                logger.info( f"Processing XML {sourceXML.name} - {title}: {url}" )
-
-                srcUUID = db.update_source( title, url )
-
-                paraIndex = -1
-                for para in source.findall('para'):
-                    paraIndex = paraIndex + 1
-                    logger.info( f"Parsing paragraph: {paraIndex}" )
-                    parsed = nlp( para.text.replace("[","").replace("]","") )
-
-                    if options.doTokens:
-                        for tok in parsed:
-                            sys.stdout.write( f"{tok.text}  " )
-                            sys.stdout.flush()
-                            
-                            db.update_token( srcUUID, paraIndex, tok )
-                        sys.stdout.write( "\n" )
-                        logger.info( "EOL" )
-
-                    if options.doEntities:
-                        for ent in parsed.ents:
-                            db.update_entity( srcUUID, paraIndex, ent )
-    
-    elif options.sourceTXT != None:
-        logger.warning( "NOTE: The text parser has no notion of paragraphs, so will use the entire document as paragraph = 0" )
-        with open( options.inputTXT, mode='r' ) as sourceTXT:
-            title = os.path.basename( sourceTXT.name )
-            url = sourceTXT.name
+class LazyPipeline:
+    # Stands in for the spacy pipeline until something needs it, so runs with nothing left to parse never load it
 
-            logger.info( "Processing TXT...", title, url )
+    def __init__( self, options ):
+        self.options = options
+        self.nlp = None
 
-            srcUUID = db.update_source( title, url )
-            
-            parsed = nlp( sourceTXT.read() )
-
-            if options.doTokens:
-                paraIndex = 0
-                for tok in parsed:
-                    sys.stdout.write( f"{tok.text}  " )
-                    sys.stdout.flush()
-                    
-                    db.update_token( srcUUID, paraIndex, tok )
-                sys.stdout.write( "\n" )
-                logger.info( "EOL" )
-
-            if options.doEntities:
-                for ent in parsed.ents:
-                    db.update_entity( srcUUID, paraIndex, ent )
+    def load( self ):
+        if self.nlp is None:
+            self.nlp = loadPipeline( self.options )
+        return self.nlp
+
+    def pipe( self, texts, **kwargs ):
+        texts = iter( texts )
+        try:
+            first = next( texts )
+        except StopIteration:
+            return iter( () )
+        return self.load().pipe( itertools.chain( [first], texts ), **kwargs )
+
+    def __call__( self, text ):
+        return self.load()( text )
+
+    def __getattr__( self, name ):
+        return getattr( self.load(), name )
+
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    (options, args) = parser.parse_args()
+
+    nlp = LazyPipeline( options )
+    db = Spacy2Neo4j( export=options.export, concurrency=options.concurrency )
+
+    cache = None
+    if options.parseCache is not None:
+        from parsecache import ParseCache
+        cache = ParseCache( options.parseCache, options.parseCacheSize * 1024 * 1024 )
+        if options.doPymusas:
+            registerPymusasTags()
+
+    logger.info( f"Ready in {time.perf_counter() - started:.2f}s (the model loads when the first paragraph needs parsing)" )
+
+    if options.inputXML != None:
+        runPipeline( db, nlp, readXML( options.inputXML ), options, cache )
+    
+    elif options.inputTXT != None:
+        runPipeline( db, nlp, readTXT( options.inputTXT, options.maxChunk ), options, cache )
             
-    db.close()
\ No newline at end of file
+    if cache is not None:
+        cache.close()
+    db.close()
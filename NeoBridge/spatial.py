@@ -0,0 +1,79 @@
+from collections import defaultdict
+import math
+
+EARTH_RADIUS = 6371008.8
+
+# Degrees of latitude per metre, near enough
+METRE_DEGREES = 1.0 / 111320.0
+
+
+def distance( lat1, lon1, lat2, lon2 ):
+    # Great circle (haversine) distance in metres, as point.distance() gives for WGS-84 points
+    (p1, p2) = (math.radians( lat1 ), math.radians( lat2 ))
+    dp = p2 - p1
+    dl = math.radians( lon2 - lon1 )
+    a = math.sin( dp / 2 ) ** 2 + math.cos( p1 ) * math.cos( p2 ) * math.sin( dl / 2 ) ** 2
+    return 2 * EARTH_RADIUS * math.asin( min( 1.0, math.sqrt( a ) ) )
+
+
+def toFloat( value ):
+    try:
+        return float( value )
+    except (TypeError, ValueError):
+        return None
+
+
+class PointGrid:
+    # Pure-Python stand-in for the Place point index: places bucketed into cellDegrees square cells.
+    # Answers the same queries as NeoBridge's spatial API, with the same (uuid, name, lat, lon, metres) rows
+
+    def __init__( self, cellDegrees = 0.1 ):
+        self.cellDegrees = cellDegrees
+        self.cells = defaultdict( list )
+        self.count = 0
+
+    def _cell( self, lat, lon ):
+        return (int( math.floor( lat / self.cellDegrees ) ), int( math.floor( lon / self.cellDegrees ) ))
+
+    def add( self, nodeUUID, name, lat, lon ):
+        (lat, lon) = (toFloat( lat ), toFloat( lon ))
+        if lat is None or lon is None:
+            return
+        self.cells[self._cell( lat, lon )].append( (nodeUUID, name, lat, lon) )
+        self.count = self.count + 1
+
+    def __len__( self ):
+        return self.count
+
+    def _box( self, south, west, north, east ):
+        (low, high) = (self._cell( south, west ), self._cell( north, east ))
+        for y in range( low[0], high[0] + 1 ):
+            for x in range( low[1], high[1] + 1 ):
+                yield from self.cells.get( (y, x), [] )
+
+    def within( self, lat, lon, metres ):
+        dLat = metres * METRE_DEGREES
+        dLon = dLat / max( 0.01, math.cos( math.radians( lat ) ) )
+
+        rows = []
+        for (nodeUUID, name, pLat, pLon) in self._box( lat - dLat, lon - dLon, lat + dLat, lon + dLon ):
+            d = distance( lat, lon, pLat, pLon )
+            if d <= metres:
+                rows.append( (nodeUUID, name, pLat, pLon, d) )
+        return sorted( rows, key=lambda row: row[4] )
+
+    def nearest( self, lat, lon, k ):
+        # Widen the search until it holds k places (or everything we have)
+        metres = self.cellDegrees / METRE_DEGREES
+        while True:
+            rows = self.within( lat, lon, metres )
+            if len(rows) >= k or len(rows) >= self.count or metres > math.pi * EARTH_RADIUS:
+                return rows[:k]
+            metres = metres * 2
+
+    def inBox( self, south, west, north, east ):
+        rows = []
+        for (nodeUUID, name, pLat, pLon) in self._box( south, west, north, east ):
+            if south <= pLat <= north and west <= pLon <= east:
+                rows.append( (nodeUUID, name, pLat, pLon, None) )
+        return rows
@@ -0,0 +1,136 @@
+from loguru import logger
+import threading
+import time
+
+
+def runStatements( tx, statements, args ):
+    # Drives a generator that yields (query, params) and is sent back each statement's records,
+    # so the same statements can be run by a sync or an async transaction (see asyncwriter)
+    gen = statements( *args )
+    try:
+        (query, params) = next( gen )
+        while True:
+            records = list( tx.run( query, params ) )
+            (query, params) = gen.send( records )
+    except StopIteration as stop:
+        return stop.value
+
+
+class UnitOfWork:
+    # One long-lived session per bridge. Writes that don't need a result are queued and replayed
+    # in a managed write transaction (so the driver retries transient errors) every maxOps
+    # statements or maxMillis milliseconds; anything that reads commits the queue first. The time
+    # limit is kept by a background thread, so queued writes still commit while the caller is busy
+    # elsewhere (parsing, say); everything touching the session holds the lock.
+
+    def __init__( self, driver, maxOps = 1000, maxMillis = 1000 ):
+        self.driver = driver
+        self.maxOps = maxOps
+        self.maxMillis = maxMillis
+        self.session = None
+        self.pending = []
+        self.started = None
+        self.commits = 0
+
+        self.lock = threading.RLock()
+        self.flusher = None
+        self.stopping = None
+        self.error = None
+
+    def _session( self ):
+        if self.session is None:
+            self.session = self.driver.session()
+        return self.session
+
+    def run( self, query, **params ):
+        with self.lock:
+            self._raiseError()
+            if self.started is None:
+                self.started = time.monotonic()
+            self.pending.append( (query, params) )
+
+            if len(self.pending) >= self.maxOps or (time.monotonic() - self.started) * 1000 >= self.maxMillis:
+                self.commit()
+            else:
+                self._startFlusher()
+
+    def commit( self ):
+        with self.lock:
+            self._raiseError()
+            if len(self.pending) == 0:
+                return
+
+            (ops, self.pending, self.started) = (self.pending, [], None)
+            self._session().execute_write( self._replay, ops )
+            self.commits = self.commits + 1
+
+    def _raiseError( self ):
+        # A background commit that failed is reported to the next caller
+        if self.error is not None:
+            (error, self.error) = (self.error, None)
+            raise error
+
+    def _startFlusher( self ):
+        if self.flusher is None and self.maxMillis > 0:
+            self.stopping = threading.Event()
+            self.flusher = threading.Thread( target=self._flush, args=(self.stopping,), name="UnitOfWorkFlush", daemon=True )
+            self.flusher.start()
+
+    def _flush( self, stopping ):
+        while not stopping.wait( self.maxMillis / 1000.0 ):
+            with self.lock:
+                if self.started is None or (time.monotonic() - self.started) * 1000 < self.maxMillis:
+                    continue
+                try:
+                    self.commit()
+                except Exception as e:
+                    logger.exception( "Background commit failed" )
+                    self.error = e
+
+    @staticmethod
+    def _replay( tx, ops ):
+        for (query, params) in ops:
+            tx.run( query, params ).consume()
+
+    def write( self, work, *args, **kwargs ):
+        with self.lock:
+            self.commit()
+            return self._session().execute_write( work, *args, **kwargs )
+
+    def read( self, work, *args, **kwargs ):
+        with self.lock:
+            self.commit()
+            return self._session().execute_read( work, *args, **kwargs )
+
+    def query( self, query, **params ):
+        # A write that we need the records back from, in its own transaction
+        return self.write( self._records, query, params )
+
+    def fetch( self, query, **params ):
+        return self.read( self._records, query, params )
+
+    @staticmethod
+    def _records( tx, query, params ):
+        return list( tx.run( query, params ) )
+
+    def autocommit( self, query, **params ):
+        # Schema changes and CALL {} IN TRANSACTIONS can't run inside an explicit transaction
+        with self.lock:
+            self.commit()
+            self._session().run( query, params ).consume()
+
+    def setDriver( self, driver ):
+        self.close()
+        self.driver = driver
+
+    def close( self ):
+        with self.lock:
+            if self.flusher is not None:
+                self.stopping.set()
+                self.flusher = None
+
+            self.commit()
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+        logger.debug( f"Unit of work closed after {self.commits} commits" )